@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+"""
+Benchmarks for drill. Run ``python benchmarks.py`` to run them all, or pass benchmark names to run only those.
+
+The ``suite`` benchmark times parsing, querying, and writing synthetic documents of several shapes with both drill and
+ElementTree. Use ``--output results.json`` to save its results, and ``--compare results.json`` on a later run to report
+the change against them.
+"""
+
+import drill
+
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def generate_tree(width=10, depth=5, attrs=2):
+    """
+    Builds a synthetic tree with ``width`` children per node, ``depth`` levels deep.
+    """
+    root = drill.XmlElement('root')
+    level = [root]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(width):
+                a = dict(('attr%d' % n, 'value %d & %d' % (d, i)) for n in range(attrs))
+                next_level.append(parent.append('node%d' % d, a, 'text <%d>' % i))
+        level = next_level
+    return root
+
+
+def generate_xml(records=100000):
+    """
+    Generates a flat XML document of ``records`` records, each with a few attributes and child elements.
+    """
+    parts = [b'<?xml version="1.0" encoding="utf-8"?>\n<catalog name="benchmark">\n']
+    for i in range(records):
+        parts.append((
+            '  <item id="item%d" sku="%06d" type="%s">\n'
+            '    <title language="en">Item number %d</title>\n'
+            '    <price currency="USD">%d.99</price>\n'
+            '    <description>A description of item %d, which is %s.</description>\n'
+            '  </item>\n' % (i, i, ('book', 'magazine', 'music')[i % 3], i, i % 100, i, 'available' if i % 2 else 'sold out')
+        ).encode('utf-8'))
+    parts.append(b'</catalog>\n')
+    return b''.join(parts)
+
+
+def retained_memory(func):
+    """
+    Returns the result of func, and the number of bytes it allocated and kept.
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def timed(func, repeat=3):
+    """
+    Returns the best wall-clock time of ``repeat`` calls to func.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def recursive_write(element, writer):
+    """
+    The recursive serializer used by XmlElement.write before drill 1.3, kept for comparison.
+    """
+    multiline = bool(element._children)
+    newline_start = multiline and not bool(element.data)
+    writer.start(element.tagname, element.attrs, newline=newline_start)
+    if element.data:
+        writer.data(element.data, newline=bool(element._children))
+    for c in element._children:
+        recursive_write(c, writer)
+    writer.end(element.tagname, indent=multiline)
+
+
+@benchmark
+def write():
+    root = generate_tree(width=10, depth=5)
+    count = len(list(root.iter())) + 1
+
+    def iterative():
+        writer = drill.XmlWriter(drill.bytes_io())
+        root.write(writer)
+
+    def recursive():
+        writer = drill.XmlWriter(drill.bytes_io())
+        recursive_write(root, writer)
+        writer.flush()
+
+    for name, func in (('iterative', iterative), ('recursive', recursive)):
+        elapsed = timed(func)
+        print('write (%s): %d elements in %.3fs (%.0f elements/s)' % (name, count, elapsed, count / elapsed))
+
+
+@benchmark
+def compact():
+    xml = generate_xml()
+    for name, kwargs in (('tree', {}), ('compact', {'compact': True})):
+        doc, size = retained_memory(lambda: drill.parse(xml, **kwargs))
+        elapsed = timed(lambda: drill.parse(xml, **kwargs), repeat=1)
+        print('parse (%s): %.1f MB of XML in %.3fs, %.1f MB retained' % (name, len(xml) / 1048576.0, elapsed, size / 1048576.0))
+        del doc
+
+
+@benchmark
+def interning():
+    xml = generate_xml()
+    for name, kwargs in (('default', {}), ('intern_values', {'intern_values': True})):
+        doc, size = retained_memory(lambda: drill.parse(xml, **kwargs))
+        print('parse (%s): %.1f MB retained' % (name, size / 1048576.0))
+    # Elements without attributes share one empty dict instead of each having their own.
+    bare = sum(1 for e in doc.iter() if not e._attrs)
+    print('%d elements without attributes, saving %.1f MB of empty dicts' % (bare, bare * sys.getsizeof({}) / 1048576.0))
+
+
+@benchmark
+def lazy():
+    xml = generate_xml()
+    for name, kwargs in (('tree', {}), ('lazy', {'lazy': True})):
+        elapsed = timed(lambda: drill.parse(xml, **kwargs)[500].first('title'), repeat=1)
+        doc, size = retained_memory(lambda: drill.parse(xml, **kwargs))
+        print('parse (%s): first access after %.3fs, %.1f MB retained' % (name, elapsed, size / 1048576.0))
+
+
+@benchmark
+def mapped():
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(generate_xml())
+        size = os.path.getsize(path) / 1048576.0
+
+        def iterate(**kwargs):
+            for item in drill.iterparse(path, **kwargs):
+                pass
+
+        for name, func in (
+                ('parse, ParseFile', lambda: drill.parse(path)),
+                ('parse, mmap', lambda: drill.parse(path, use_mmap=True)),
+                ('iterparse, read', lambda: iterate()),
+                ('iterparse, mmap', lambda: iterate(use_mmap=True))):
+            elapsed = timed(func)
+            print('%s: %.1f MB in %.3fs (%.1f MB/s)' % (name, size, elapsed, size / elapsed))
+    finally:
+        os.remove(path)
+
+
+@benchmark
+def chunking():
+    xml = generate_xml()
+    size = len(xml) / 1048576.0
+
+    def iterate(**kwargs):
+        for item in drill.iterparse(drill.bytes_io(xml), xpath='catalog/item', release=True, **kwargs):
+            pass
+
+    for name, kwargs in (('fixed 16 KB', {}), ('fixed 1 MB', {'chunk_size': 1048576}), ('adaptive', {'adaptive': True})):
+        elapsed = timed(lambda: iterate(**kwargs))
+        print('iterparse (%s): %.1f MB in %.3fs (%.1f MB/s)' % (name, size, elapsed, size / elapsed))
+
+
+@benchmark
+def snapshot():
+    xml = generate_xml()
+    fd, path = tempfile.mkstemp(suffix='.snapshot')
+    os.close(fd)
+    try:
+        drill.parse(xml).save_snapshot(path)
+        print('snapshot: %.1f MB of XML, %.1f MB snapshot' % (len(xml) / 1048576.0, os.path.getsize(path) / 1048576.0))
+        for name, func in (
+                ('parse', lambda: drill.parse(xml)),
+                ('load_snapshot', lambda: drill.load_snapshot(path)),
+                ('load_snapshot, compact', lambda: drill.load_snapshot(path, compact=True)[500].title.data)):
+            print('%s: %.3fs' % (name, timed(func)))
+    finally:
+        os.remove(path)
+
+
+def record_id(elem):
+    return elem.attrs['id']
+
+
+@benchmark
+def parallel():
+    import multiprocessing
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(generate_xml(records=400000))
+        size = os.path.getsize(path) / 1048576.0
+
+        def serial():
+            for item in drill.iterparse(path, xpath='catalog/item', release=True):
+                record_id(item)
+
+        elapsed = timed(serial, repeat=1)
+        print('iterparse: %.1f MB in %.3fs (%.1f MB/s)' % (size, elapsed, size / elapsed))
+        workers = 1
+        while workers <= multiprocessing.cpu_count():
+            elapsed = timed(lambda: list(drill.parallel_iterparse(path, 'catalog/item', workers=workers, func=record_id)),
+                            repeat=1)
+            print('parallel_iterparse (%d workers): %.1f MB in %.3fs (%.1f MB/s)' % (workers, size, elapsed, size / elapsed))
+            workers *= 2
+    finally:
+        os.remove(path)
+
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', '&', '<caf\xe9>')
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for i in range(words)).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def generate_document(shape, elements=50000, seed=1):
+    """
+    Generates a deterministic synthetic document of about ``elements`` elements, for the given seed.
+
+    :param shape: One of ``wide`` (many small records), ``deep`` (long chains of nested sections), ``attrs`` (rows of
+        many attributes), or ``text`` (records with long paragraphs of text)
+    :returns: A tuple of ``(xml, queries)``, where ``queries`` is a dict of equivalent drill and ElementTree queries
+    """
+    rng = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="utf-8"?>\n<root>\n']
+    if shape == 'wide':
+        for i in range(elements // 3):
+            parts.append('<record id="r%d" type="%s"><name>%s</name><value>%d</value></record>\n' % (
+                i, rng.choice('abc'), _text(rng, 2), rng.randint(0, 1000)))
+        queries = {'xpath': 'root/record', 'tag': 'name', 'attr': ('record', 'type', 'b')}
+    elif shape == 'deep':
+        depth = 50
+        for i in range(elements // depth):
+            for level in range(depth - 1):
+                parts.append('<section level="%d">' % level)
+            parts.append('<leaf id="l%d">%s</leaf>' % (i, _text(rng, 3)))
+            parts.append('</section>' * (depth - 1) + '\n')
+        queries = {'xpath': 'root/section', 'tag': 'leaf', 'attr': ('section', 'level', '25')}
+    elif shape == 'attrs':
+        for i in range(elements):
+            attrs = ' '.join('a%d="%s"' % (n, rng.choice(WORDS[:8])) for n in range(20))
+            parts.append('<row id="%d" %s/>\n' % (i, attrs))
+        queries = {'xpath': 'root/row', 'tag': 'row', 'attr': ('row', 'a3', 'dolor')}
+    elif shape == 'text':
+        for i in range(elements // 3):
+            parts.append('<doc id="d%d" lang="%s"><title>%s</title><body>%s</body></doc>\n' % (
+                i, rng.choice(('en', 'fr')), _text(rng, 5), _text(rng, 100)))
+        queries = {'xpath': 'root/doc', 'tag': 'title', 'attr': ('doc', 'lang', 'fr')}
+    else:
+        raise ValueError('Unknown document shape: %s' % shape)
+    parts.append('</root>\n')
+    return ''.join(parts).encode('utf-8'), queries
+
+
+def measure(func, repeat=3):
+    """
+    Returns the best wall-clock time of ``repeat`` calls to func, and the peak memory allocated during one call.
+    """
+    elapsed = timed(func, repeat)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def _drain(iterator):
+    count = 0
+    for item in iterator:
+        count += 1
+    return count
+
+
+def _et_iterparse(xml, tag=None):
+    count = 0
+    for event, elem in ET.iterparse(io.BytesIO(xml)):
+        if tag is None or elem.tag == tag:
+            count += 1
+            elem.clear()
+    return count
+
+
+def suite_operations(xml, queries):
+    """
+    Returns a list of ``(operation, library, func)`` tuples to time against one document.
+    """
+    doc = drill.parse(xml)
+    tree = ET.fromstring(xml)
+    record = queries['xpath'].split('/')[-1]
+    tag, (attr_tag, attr, value) = queries['tag'], queries['attr']
+    return [
+        ('parse', 'drill', lambda: drill.parse(xml)),
+        ('parse', 'etree', lambda: ET.fromstring(xml)),
+        ('iterparse', 'drill', lambda: _drain(drill.iterparse(io.BytesIO(xml)))),
+        ('iterparse', 'etree', lambda: _et_iterparse(xml)),
+        ('iterparse_xpath', 'drill', lambda: _drain(drill.iterparse(io.BytesIO(xml), xpath=queries['xpath'],
+                                                                     release=True))),
+        ('iterparse_xpath', 'etree', lambda: _et_iterparse(xml, record)),
+        ('find_deep', 'drill', lambda: _drain(doc.find('//' + tag))),
+        ('find_deep', 'etree', lambda: _drain(tree.iterfind('.//' + tag))),
+        ('find_predicate', 'drill', lambda: _drain(doc.find('//%s[@%s="%s"]' % (attr_tag, attr, value)))),
+        ('find_predicate', 'etree', lambda: _drain(tree.iterfind(".//%s[@%s='%s']" % (attr_tag, attr, value)))),
+        ('iter', 'drill', lambda: _drain(doc.iter())),
+        ('iter', 'etree', lambda: _drain(tree.iter())),
+        ('xml', 'drill', lambda: doc.xml(pretty=False)),
+        ('xml', 'etree', lambda: ET.tostring(tree)),
+        ('json', 'drill', lambda: doc.json(attributes=True)),
+    ]
+
+
+def run_suite(shapes=('wide', 'deep', 'attrs', 'text'), elements=50000, repeat=3, seed=1):
+    """
+    Runs every suite operation against every document shape, printing and returning the results.
+    """
+    results = []
+    for shape in shapes:
+        xml, queries = generate_document(shape, elements, seed)
+        size = len(xml) / 1048576.0
+        count = xml.count(b'<') - xml.count(b'</') - 1
+        print('%s: %.1f MB, %d elements' % (shape, size, count))
+        for operation, library, func in suite_operations(xml, queries):
+            elapsed, peak = measure(func, repeat)
+            results.append({
+                'shape': shape,
+                'operation': operation,
+                'library': library,
+                'seconds': elapsed,
+                'mb_per_second': size / elapsed,
+                'elements_per_second': count / elapsed,
+                'peak_mb': peak / 1048576.0,
+            })
+            print('  %-16s %-6s %8.3fs %8.1f MB/s %10.0f elements/s %8.1f MB peak' % (
+                operation, library, elapsed, size / elapsed, count / elapsed, peak / 1048576.0))
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Prints the change in time of each drill result against a baseline run, flagging those more than ``threshold``
+    slower. Returns the number of regressions.
+    """
+    old = dict(((r['shape'], r['operation'], r['library']), r['seconds']) for r in baseline['results'])
+    regressions = 0
+    for r in results:
+        key = (r['shape'], r['operation'], r['library'])
+        if r['library'] != 'drill' or key not in old:
+            continue
+        change = r['seconds'] / old[key] - 1.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-6s %-16s %+6.1f%%%s' % (r['shape'], r['operation'], change * 100.0, flag))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Runs drill benchmarks.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (defaults to all of them)')
+    parser.add_argument('--elements', type=int, default=50000, help='the approximate size of suite documents')
+    parser.add_argument('--repeat', type=int, default=3, help='the number of timed runs of each suite operation')
+    parser.add_argument('--seed', type=int, default=1, help='the seed for generating suite documents')
+    parser.add_argument('--output', help='write suite results to this JSON file')
+    parser.add_argument('--compare', help='compare suite results to this JSON file')
+    args = parser.parse_args(argv)
+    for func in BENCHMARKS:
+        if not args.names or func.__name__ in args.names:
+            func()
+    if not args.names or 'suite' in args.names:
+        results = run_suite(elements=args.elements, repeat=args.repeat, seed=args.seed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({
+                    'drill': drill.__version__,
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'elements': args.elements,
+                    'seed': args.seed,
+                    'results': results,
+                }, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                return 1 if compare(results, json.load(f)) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -3,33 +3,85 @@ __version__ = '.'.join(str(i) for i in __version_info__)
 
 from xml.parsers import expat
 from xml.sax.saxutils import escape, quoteattr
+from json.encoder import encode_basestring_ascii
+import array
+import collections
 import contextlib
+import gc
+import json
+import mmap
+import os
 import re
+import socket
+import struct
 import sys
+import threading
+import zlib
 
 
 PY3 = sys.version_info[0] == 3
 
 if PY3:
     from io import BytesIO as bytes_io
+    from urllib.parse import urljoin, urlsplit
+    import http.client as http_client
     import urllib.request as url_lib
     unicode = str
+    unichr = chr
     basestring = str
     xrange = range
 else:
     from cStringIO import StringIO as bytes_io
+    from urlparse import urljoin, urlsplit
+    import httplib as http_client
     import urllib2 as url_lib
 
+# The array typecode used for offsets into text buffers, which may be larger than 2 GB.
+OFFSET_TYPECODE = 'q' if PY3 else 'l'
+
 xpath_re = re.compile(r'(?P<tag>[a-zA-Z0-9_\-\.\*]+)(?P<predicate>\[.+\])?')
 num_re = re.compile(r'[0-9\-]+')
 
+# The XML declaration, comments, processing instructions, and doctype before the root element.
+prolog_re = re.compile(br'(?:\xef\xbb\xbf)?(?:\s+|<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^\[>]*(?:\[.*?\])?\s*>)*', re.DOTALL)
+# Matches a complete start tag (or empty element tag), taking quoted attribute values into account.
+start_tag_re = re.compile(br'<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/?>')
+
+
+class _EmptyAttrs (dict):
+    """
+    The type of the empty attribute dict shared by all elements without attributes (see XmlElement.attrs). It can't be
+    modified, and pickles and copies to the same shared instance, so unpickled or copied elements without attributes
+    don't end up sharing an ordinary dict.
+    """
+
+    def __reduce__(self):
+        return '_EMPTY_ATTRS'
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('The shared empty attribute dict is read-only.')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+_EMPTY_ATTRS = _EmptyAttrs()
+
 
 class XmlWriter (object):
     """
-    A class for safely writing XML to a stream, with optional pretty-printing and replacements.
+    A class for safely writing XML to a stream, with optional pretty-printing and replacements. Output is collected and
+    written to the stream in encoded chunks of roughly ``buffer_size`` characters, and whenever the outermost element is
+    closed. Call :meth:`flush` to force any buffered output to be written.
     """
 
-    def __init__(self, stream, encoding='utf-8', pretty=True, indent='    ', level=0, invalid='', replacements=None):
+    def __init__(self, stream, encoding='utf-8', pretty=True, indent='    ', level=0, invalid='', replacements=None,
+                 buffer_size=65536):
         self.stream = stream
         self.encoding = encoding
         self.pretty = pretty
@@ -41,42 +93,180 @@ class XmlWriter (object):
                 self.replacements[chr(c)] = invalid
         if replacements:
             self.replacements.update(replacements)
-        self.indent = escape(indent, self.replacements)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._base_level = level
+        # For each element opened with element(), whether any child elements have been written to it yet.
+        self._open = []
+        # Precompute translation tables for escaping text and attribute values in a single pass. This only works if all
+        # the replacements are single characters, otherwise fall back to xml.sax.saxutils.
+        self._escape_table = None
+        self._attr_table = None
+        if all(len(k) == 1 for k in self.replacements):
+            self._escape_table = {ord('&'): '&amp;', ord('<'): '&lt;', ord('>'): '&gt;'}
+            for k, v in self.replacements.items():
+                self._escape_table[ord(k)] = v
+            self._attr_table = dict(self._escape_table)
+            self._attr_table.update({ord('\n'): '&#10;', ord('\r'): '&#13;', ord('\t'): '&#9;'})
+            # Most strings don't need escaping at all, and a regex search is much cheaper than translating them.
+            self._escape_re = re.compile('[%s]' % re.escape(''.join(unichr(c) for c in self._escape_table)))
+            self._attr_re = re.compile('[%s]' % re.escape(''.join(unichr(c) for c in self._attr_table)))
+        # Tag and attribute names tend to repeat, so their escaped forms are cached.
+        self._names = {}
+        self.indent = self.escape(indent)
+
+    def escape(self, data):
+        """
+        Escapes &, <, and > (and any replacements) in a string of data.
+        """
+        data = unicode(data)
+        if self._escape_table is None:
+            return escape(data, self.replacements)
+        if self._escape_re.search(data) is None:
+            return data
+        return data.translate(self._escape_table)
+
+    def escape_name(self, name):
+        """
+        Escapes a tag or attribute name, caching the result.
+        """
+        try:
+            return self._names[name]
+        except KeyError:
+            escaped = self._names[name] = self.escape(name)
+            return escaped
+
+    def quoteattr(self, data):
+        """
+        Escapes and quotes a string of data for use as an attribute value.
+        """
+        data = unicode(data)
+        if self._attr_table is None:
+            return quoteattr(data, self.replacements)
+        if self._attr_re.search(data) is not None:
+            data = data.translate(self._attr_table)
+        if '"' in data:
+            if "'" in data:
+                return '"%s"' % data.replace('"', '&quot;')
+            return "'%s'" % data
+        return '"%s"' % data
 
     def _write(self, data):
-        self.stream.write(data.encode(self.encoding))
+        if not self.buffer_size:
+            self.stream.write(data.encode(self.encoding))
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Encodes and writes any buffered output to the stream.
+        """
+        if self._buffer:
+            self.stream.write(''.join(self._buffer).encode(self.encoding))
+            self._buffer = []
+            self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            # Anything still buffered belongs to an unfinished element, so don't write it out.
+            self._buffer = []
+            self._buffered = 0
+        self.flush()
+
+    def _child(self):
+        """
+        Called before writing a child element, so the first child of an element opened with :meth:`element` can start
+        on a new line.
+        """
+        if self._open and not self._open[-1]:
+            self._open[-1] = True
+            if self.pretty:
+                self._write('\n')
+
+    def declaration(self):
+        """
+        Writes an XML declaration, including the encoding of this writer.
+        """
+        self._write('<?xml version="1.0" encoding=%s?>\n' % self.quoteattr(self.encoding))
+
+    @contextlib.contextmanager
+    def element(self, tag, attrs=None, data=None):
+        """
+        A context manager that writes a start tag on entry and the matching end tag on exit. Anything written inside
+        the ``with`` block (more elements, data, or :class:`XmlElement` trees passed to :meth:`serialize`) becomes the
+        element's content, so large documents can be streamed out without building a tree first::
+
+            with XmlWriter(f) as w:
+                with w.element('rows'):
+                    for row in rows:
+                        with w.element('row', {'id': row.id}):
+                            w.simple_tag('name', data=row.name)
+
+        The output is the same as if the equivalent tree had been written with :meth:`serialize`. If the ``with`` block
+        raises an exception, no end tag is written, but the writer's nesting level is restored so it stays usable.
+
+        :param tag: The tag name of the element
+        :param attrs: Attributes for the element
+        :param data: Character data for the element, written right after the start tag
+        """
+        level = self.level
+        self.start(tag, attrs or {}, newline=False)
+        if data is not None:
+            self.data(data)
+        self._open.append(False)
+        try:
+            yield self
+        except BaseException:
+            self._open.pop()
+            self.level = level
+            raise
+        has_children = self._open.pop()
+        self.end(tag, indent=has_children)
 
     def data(self, data, newline=False):
-        self._write(escape(unicode(data).strip(), self.replacements))
+        data = self.escape(unicode(data).strip())
         if self.pretty and newline:
-            self._write('\n')
+            data += '\n'
+        self._write(data)
 
     def start(self, tag, attrs, newline=False):
+        self._child()
+        parts = []
         if self.pretty:
-            self._write(self.indent * self.level)
-        self._write('<')
-        self._write(escape(tag, self.replacements))
+            parts.append(self.indent * self.level)
+        parts.append('<')
+        parts.append(self.escape_name(tag))
         for attr, value in attrs.items():
             if value is None:
                 value = ''
-            self._write(' ')
-            self._write(escape(unicode(attr), self.replacements))
-            self._write('=')
-            self._write(quoteattr(unicode(value), self.replacements))
-        self._write('>')
+            parts.append(' %s=%s' % (self.escape_name(attr), self.quoteattr(value)))
+        parts.append('>')
         if self.pretty and newline:
-            self._write('\n')
+            parts.append('\n')
+        self._write(''.join(parts))
         self.level += 1
 
     def end(self, tag, indent=False, newline=True):
         self.level -= 1
+        parts = []
         if self.pretty and indent:
-            self._write(self.indent * self.level)
-        self._write('</')
-        self._write(escape(tag, self.replacements))
-        self._write('>')
+            parts.append(self.indent * self.level)
+        parts.append('</')
+        parts.append(self.escape_name(tag))
+        parts.append('>')
         if self.pretty and newline:
-            self._write('\n')
+            parts.append('\n')
+        self._write(''.join(parts))
+        if self.level <= self._base_level:
+            # The outermost element is finished, so make sure it makes it to the stream.
+            self.flush()
 
     def simple_tag(self, tag, attrs={}, data=None):
         self.start(tag, attrs, newline=False)
@@ -84,35 +274,379 @@ class XmlWriter (object):
             self.data(data, newline=False)
         self.end(tag, indent=False)
 
+    def serialize(self, element):
+        """
+        Writes an element (including descendants) to the stream. This produces the same output as calling
+        :meth:`start`, :meth:`data`, and :meth:`end` for each node, but walks the tree with an explicit stack instead of
+        recursing, and writes each node's markup in one go.
+
+        :param element: The :class:`XmlElement` to write
+        """
+        self._child()
+        pretty = self.pretty
+        indent = self.indent
+        esc = self.escape
+        name = self.escape_name
+        quote = self.quoteattr
+        write = self._write
+        level = self.level
+        # A stack of (element, children iterator) for elements with children that are still open.
+        stack = [(None, iter((element,)))]
+        while stack:
+            parent, children = stack[-1]
+            for c in children:
+                break
+            else:
+                stack.pop()
+                if parent is not None:
+                    level -= 1
+                    if pretty:
+                        write('%s</%s>\n' % (indent * level, name(parent.tagname)))
+                    else:
+                        write('</%s>' % name(parent.tagname))
+                continue
+            multiline = bool(c._children)
+            parts = []
+            if pretty:
+                parts.append(indent * level)
+            parts.append('<')
+            parts.append(name(c.tagname))
+            for attr, value in c._attrs.items():
+                if value is None:
+                    value = ''
+                parts.append(' %s=%s' % (name(attr), quote(value)))
+            parts.append('>')
+            if c.data:
+                parts.append(esc(unicode(c.data).strip()))
+                if pretty and multiline:
+                    parts.append('\n')
+            elif pretty and multiline:
+                parts.append('\n')
+            if multiline:
+                level += 1
+                stack.append((c, iter(c._children)))
+            else:
+                parts.append('</')
+                parts.append(name(c.tagname))
+                parts.append('>\n' if pretty else '>')
+            write(''.join(parts))
+        self.level = level
+        if level <= self._base_level:
+            self.flush()
+
+
+def _unquote(value):
+    """
+    Strips a single layer of quotes (either kind) from a predicate value.
+    """
+    if value[:1] in ('"', "'"):
+        value = value[1:]
+    if value[-1:] in ('"', "'"):
+        value = value[:-1]
+    return value
+
+
+class AttributePredicate (object):
+    """
+    A compiled ``[@attr]`` or ``[@attr=value]`` predicate.
+    """
+
+    __slots__ = ('attr', 'value')
+
+    def __init__(self, attr, value=None):
+        self.attr = attr
+        self.value = value
+
+    def match(self, element):
+        return self.match_attrs(element._attrs)
+
+    def match_attrs(self, attrs):
+        if self.value is None:
+            return self.attr in attrs
+        return attrs.get(self.attr) == self.value
+
+
+class IndexPredicate (object):
+    """
+    A compiled ``[n]`` predicate, matching the n-th (0-based) child of its parent. Negative indexes count from the end.
+    """
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def match(self, element):
+        if self.index < 0:
+            if element.parent:
+                # For negative indexes, count from the end of the list.
+                return element.index == (len(element.parent) + self.index)
+            else:
+                # If we're the root node, the only index we could be is 0.
+                return self.index == 0
+        return self.index == element.index
+
+
+class ChildPredicate (object):
+    """
+    A compiled ``[tag]`` or ``[tag=value]`` predicate, matching elements with a child of the given tag name (and data).
+    """
+
+    __slots__ = ('tag', 'value')
+
+    def __init__(self, tag, value=None):
+        self.tag = tag
+        self.value = value
+
+    def match(self, element):
+        for c in element._children:
+            if c.tagname == self.tag and (self.value is None or c.data == self.value):
+                return True
+        return False
+
+
+def compile_predicate(pred):
+    """
+    Compiles a predicate string (including the surrounding brackets) into a predicate object with a ``match`` method.
+    Returns ``None`` for an empty predicate.
+    """
+    if not pred:
+        return None
+    # Strip off the [ and ]
+    pred = pred[1:-1]
+    if pred.startswith('@'):
+        # An attribute predicate checks the existence (and optionally value) of an attribute on this tag.
+        pred = pred[1:]
+        if '=' in pred:
+            attr, value = pred.split('=', 1)
+            return AttributePredicate(attr, _unquote(value))
+        return AttributePredicate(pred)
+    elif num_re.match(pred):
+        return IndexPredicate(int(pred))
+    elif '=' in pred:
+        tag, value = pred.split('=', 1)
+        return ChildPredicate(tag, _unquote(value))
+    # A plain [tag] predicate means we match if we have a child with tagname "tag".
+    return ChildPredicate(pred)
+
+
+class QueryStep (object):
+    """
+    A single compiled step of a query: a tag name (or ``*``), an optional predicate, and whether the step should match
+    at any depth (i.e. it was preceded by ``//``).
+    """
+
+    __slots__ = ('tag', 'predicate', 'deep')
+
+    def __init__(self, tag, predicate=None, deep=False):
+        self.tag = tag
+        self.predicate = predicate
+        self.deep = deep
+
+    def __repr__(self):
+        return '<%s %s%s>' % (self.__class__.__name__, '//' if self.deep else '', self.tag)
+
+    def match(self, element):
+        if self.tag != '*' and self.tag != element.tagname:
+            return False
+        return self.predicate is None or self.predicate.match(element)
+
+
+def compile_step(part, deep=False):
+    """
+    Compiles a single query part such as ``book[@id="x"]`` into a :class:`QueryStep`.
+    """
+    m = xpath_re.match(part)
+    if m is None:
+        raise ValueError('Invalid query part: %r' % part)
+    tag, predicate = m.groups()
+    return QueryStep(tag, compile_predicate(predicate), deep)
+
+
+class QueryStats (object):
+    """
+    Counters for the work done by a query, see :meth:`XmlElement.find`. Queries answered from an :class:`XmlIndex` are
+    counted in ``index_searches``, and don't visit any nodes.
+    """
+
+    def __init__(self):
+        self.nodes_visited = 0
+        self.predicates_evaluated = 0
+        self.index_searches = 0
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ' '.join('%s=%s' % item for item in sorted(self.as_dict().items())))
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def steps(self, steps):
+        """
+        Returns copies of a list of :class:`QueryStep` objects that count their work in these stats.
+        """
+        return [_CountingStep(step, self) for step in steps]
+
+
+class _CountingPredicate (object):
+    __slots__ = ('predicate', 'stats')
+
+    def __init__(self, predicate, stats):
+        self.predicate = predicate
+        self.stats = stats
+
+    def match(self, element):
+        self.stats.predicates_evaluated += 1
+        return self.predicate.match(element)
+
+
+class _CountingStep (QueryStep):
+    __slots__ = ('stats',)
+
+    def __init__(self, step, stats):
+        predicate = None if step.predicate is None else _CountingPredicate(step.predicate, stats)
+        super(_CountingStep, self).__init__(step.tag, predicate, step.deep)
+        self.stats = stats
+
+    def match(self, element):
+        self.stats.nodes_visited += 1
+        return super(_CountingStep, self).match(element)
+
+
+class CompiledQuery (object):
+    """
+    A simplified XPath query, parsed once into a list of :class:`QueryStep` objects. Instances are reusable, and may be
+    passed anywhere a query string is accepted (such as :meth:`XmlElement.find`).
+    """
+
+    def __init__(self, query, steps=None):
+        self.query = query
+        if steps is None:
+            steps = []
+            deep = False
+            for part in query.split('/'):
+                part = part.strip()
+                if part:
+                    steps.append(compile_step(part, deep))
+                    deep = False
+                else:
+                    # A blank part means we encountered a //, so the next step should search all sub-nodes.
+                    deep = True
+            if not steps:
+                raise ValueError('Empty query: %r' % query)
+        self.steps = steps
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.query)
+
+    def search(self, element, stats=None):
+        """
+        Returns an iterator yielding descendants of element matching this query.
+
+        :param stats: If specified, a :class:`QueryStats` object to count the work done by the search
+        """
+        index = element._index
+        if index is not None and index.root is element and len(self.steps) == 1:
+            step = self.steps[0]
+            if step.deep and step.tag != '*':
+                # A //tag[...] query from the root of an index doesn't need to walk the tree at all.
+                if stats is not None:
+                    stats.index_searches += 1
+                return index.search(step)
+        if stats is not None:
+            return self._search(element, stats.steps(self.steps))
+        return self._search(element, self.steps)
+
+    def _search(self, element, steps):
+        last = len(steps) - 1
+        # A pre-order walk with an explicit stack of (children iterator, step indexes) pairs, so matches are yielded
+        # directly from here (in document order) instead of bubbling up through one generator per tree level. Each
+        # child is visited once with every step index that applies to it, so a node reached through more than one
+        # deep step (e.g. //a//b with nested a elements) is only yielded once.
+        # Shared state tuples for the common case of a single active step, with or without the step after it.
+        alone = [(idx,) for idx in xrange(last + 2)]
+        both = [(idx, idx + 1) for idx in xrange(last + 1)]
+        stack = [(iter(element._children), alone[0])]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            children, states = stack[-1]
+            for c in children:
+                break
+            else:
+                pop()
+                continue
+            if len(states) == 1:
+                idx = states[0]
+                step = steps[idx]
+                if step.match(c):
+                    if idx == last:
+                        yield c
+                        next_states = alone[idx] if step.deep else None
+                    else:
+                        # Check the children of this child against the next query step (and the same step, if deep).
+                        next_states = both[idx] if step.deep else alone[idx + 1]
+                else:
+                    # If we're searching all sub-nodes, search with the same step, regardless of matching.
+                    next_states = alone[idx] if step.deep else None
+            else:
+                matched = False
+                next_states = []
+                for idx in states:
+                    step = steps[idx]
+                    if step.deep and idx not in next_states:
+                        next_states.append(idx)
+                    if step.match(c):
+                        if idx == last:
+                            matched = True
+                        elif idx + 1 not in next_states:
+                            next_states.append(idx + 1)
+                if matched:
+                    yield c
+                next_states = tuple(next_states)
+            if next_states and c._children:
+                push((iter(c._children), next_states))
+
+
+QUERY_CACHE_SIZE = 256
+_query_cache = collections.OrderedDict()
+_query_cache_lock = threading.Lock()
+
+
+def compile(query):
+    """
+    Compiles a simplified XPath query string into a reusable :class:`CompiledQuery`. The most recently used queries
+    (up to ``QUERY_CACHE_SIZE``) are cached, so calling :meth:`XmlElement.find` repeatedly with the same query string
+    only parses it once.
+
+    :param query: A query string, or an already-compiled :class:`CompiledQuery` (which is returned as-is)
+    :rtype: :class:`CompiledQuery`
+    """
+    if isinstance(query, CompiledQuery):
+        return query
+    with _query_cache_lock:
+        compiled = _query_cache.pop(query, None)
+        if compiled is None:
+            compiled = CompiledQuery(query)
+            while len(_query_cache) >= QUERY_CACHE_SIZE:
+                _query_cache.popitem(last=False)
+        _query_cache[query] = compiled
+    return compiled
+
 
 def traverse(element, query, deep=False):
     """
     Helper function to traverse an element tree rooted at element, yielding nodes matching the query.
+
+    :param query: A list of query parts, as returned by :func:`parse_query`
     """
-    # Grab the next part of the query (it will be chopped from the front each iteration).
-    part = query[0]
-    if not part:
-        # If the part is blank, we encountered a //, meaning search all sub-nodes.
-        query = query[1:]
-        part = query[0]
-        deep = True
-    # Parse out any predicate (tag[pred]) from this part of the query.
-    part, predicate = xpath_re.match(query[0]).groups()
-    for c in element._children:
-        if part in ('*', c.tagname) and c._match(predicate):
-            # A potential matching branch: this child matches the next query part (and predicate).
-            if len(query) == 1:
-                # If this is the last part of the query, we found a matching element, yield it.
-                yield c
-            else:
-                # Otherwise, check the children of this child against the next query part.
-                for e in traverse(c, query[1:]):
-                    yield e
-        if deep:
-            # If we're searching all sub-nodes, traverse with the same query, regardless of matching.
-            # This basically creates a recursion branch to search EVERYWHERE for anything after //.
-            for e in traverse(c, query, deep=True):
-                yield e
+    steps = []
+    for part in query:
+        if part:
+            steps.append(compile_step(part, deep))
+            deep = False
+        else:
+            deep = True
+    return CompiledQuery('/'.join(query), steps).search(element)
 
 
 def parse_query(query):
@@ -130,21 +664,116 @@ def parse_query(query):
     return norm
 
 
+class XmlIndex (object):
+    """
+    A per-document index mapping tag names to elements (in document order), and optionally mapping values of chosen
+    ``(tag, attr)`` pairs to elements. Created by :meth:`XmlElement.build_index`, and used automatically by
+    :meth:`XmlElement.find` for ``//tag`` and ``//tag[@attr="value"]`` queries, and by :meth:`XmlElement.iter` for
+    single tag names. The index is built lazily, and rebuilt after any ``append``, ``insert``, or ``clear`` in the tree.
+    Changes made directly to an element's ``tagname`` or ``attrs`` are not tracked; call :meth:`invalidate` after
+    making them.
+    """
+
+    def __init__(self, root, attrs=None):
+        self.root = root
+        self.attrs = frozenset(attrs or ())
+        self._tags = None
+        self._values = None
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.root.tagname)
+
+    def invalidate(self):
+        """
+        Marks the index as stale, so it will be rebuilt the next time it is used.
+        """
+        self._tags = None
+        self._values = None
+
+    def build(self):
+        """
+        (Re)builds the index from the current state of the tree.
+        """
+        tags = {}
+        values = {}
+        by_tag = {}
+        for tag, attr in self.attrs:
+            by_tag.setdefault(tag, []).append(attr)
+            values[(tag, attr)] = {}
+        self.root._index = self
+        # Each element points at the nearest index enclosing it, so subtrees with their own index keep it.
+        stack = [(iter(self.root._children), self)]
+        while stack:
+            for e in stack[-1][0]:
+                break
+            else:
+                stack.pop()
+                continue
+            index = e._index
+            if index is None or index.root is not e:
+                index = e._index = stack[-1][1]
+            tags.setdefault(e.tagname, []).append(e)
+            if e.tagname in by_tag:
+                for attr in by_tag[e.tagname]:
+                    if attr in e._attrs:
+                        values[(e.tagname, attr)].setdefault(e._attrs[attr], []).append(e)
+            if e._children:
+                stack.append((iter(e._children), index))
+        self._tags = tags
+        self._values = values
+
+    def elements(self, tag):
+        """
+        Returns a list of all descendants of the root element with the given tag name, in document order.
+        """
+        if self._tags is None:
+            self.build()
+        return self._tags.get(tag, [])
+
+    def lookup(self, tag, attr, value):
+        """
+        Returns a list of all descendants of the root element with the given tag name and attribute value, in document
+        order, or ``None`` if ``(tag, attr)`` is not indexed.
+        """
+        if (tag, attr) not in self.attrs:
+            return None
+        if self._values is None:
+            self.build()
+        return self._values[(tag, attr)].get(value, [])
+
+    def search(self, step):
+        """
+        Returns an iterator over descendants of the root element matching a deep :class:`QueryStep`.
+        """
+        pred = step.predicate
+        if isinstance(pred, AttributePredicate) and pred.value is not None:
+            found = self.lookup(step.tag, pred.attr, pred.value)
+            if found is not None:
+                return iter(found)
+        elements = self.elements(step.tag)
+        if pred is None:
+            return iter(elements)
+        return (e for e in elements if pred.match(e))
+
+
 class XmlQuery (object):
     """
     An iterable object returned by XmlElement.find, with convenience methods for getting the first and last elements
     of the result set.
     """
 
-    def __init__(self, root, query):
+    def __init__(self, root, query, stats=False):
         self.root = root
-        self.query = query
+        self.compiled = compile(query)
+        self.query = self.compiled.query
+        # Counts the work done by every iteration of this query, if enabled.
+        self.stats = QueryStats() if stats else None
 
     def __repr__(self):
         return '%s -> %s' % (self.root.path(), self.query)
 
     def __iter__(self):
-        return traverse(self.root, parse_query(self.query))
+        return self.compiled.search(self.root, self.stats)
 
     def first(self):
         """
@@ -163,27 +792,96 @@ class XmlQuery (object):
         return last_found
 
 
+def _json_string(value):
+    if isinstance(value, basestring):
+        return encode_basestring_ascii(value)
+    return json.dumps(value)
+
+
+def _json_value(element, attributes):
+    """
+    Returns a new dict for the JSON representation of an element, including attributes if requested.
+    """
+    if attributes:
+        return dict(('@' + k, v) for k, v in element._attrs.items())
+    return {}
+
+
+def _json_pieces(element, attributes, force_list):
+    """
+    Returns a list of the pieces of the JSON object representing element, with child elements left in place to be
+    expanded by :meth:`XmlElement.write_json`.
+    """
+    members = []
+    if attributes:
+        for k, v in element._attrs.items():
+            members.append((_json_string('@' + k), _json_string(v)))
+    groups = {}
+    for c in element._children:
+        if c.tagname in groups:
+            groups[c.tagname].append(c)
+        else:
+            groups[c.tagname] = [c]
+            members.append((_json_string(c.tagname), groups[c.tagname]))
+    if attributes and element.data:
+        members.append(('"#text"', _json_string(element.data)))
+    pieces = ['{']
+    for idx, (key, value) in enumerate(members):
+        if idx:
+            pieces.append(', ')
+        pieces.append(key)
+        pieces.append(': ')
+        if not isinstance(value, list):
+            pieces.append(value)
+        elif len(value) == 1 and value[0].tagname not in force_list:
+            pieces.append(value[0])
+        else:
+            pieces.append('[')
+            for n, c in enumerate(value):
+                if n:
+                    pieces.append(', ')
+                pieces.append(c)
+            pieces.append(']')
+    pieces.append('}')
+    return pieces
+
+
 class XmlElement (object):
     """
     A mutable object encapsulating an XML element.
     """
 
     # This makes a pretty big difference when parsing huge XML files.
-    __slots__ = ('tagname', 'parent', 'index', 'attrs', 'data', '_children')
+    __slots__ = ('tagname', 'parent', 'index', '_attrs', 'data', '_children', '_index')
 
     def __init__(self, name, attrs=None, data=None, parent=None, index=None):
         self.tagname = name
         self.parent = parent
         self.index = index  # The index of this node in the parent's children list.
-        self.attrs = {}
-        if attrs:
-            self.attrs.update(attrs)
+        # Elements without attributes share an empty dict until their attrs are accessed, see the attrs property.
+        self._attrs = dict(attrs) if attrs else _EMPTY_ATTRS
         self.data = unicode(data) if data else ''
         self._children = []
+        self._index = None  # The XmlIndex of the document this node belongs to, if any.
 
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__, self.tagname)
 
+    @property
+    def attrs(self):
+        """
+        A dict of this element's attributes.
+        """
+        attrs = self._attrs
+        if attrs is _EMPTY_ATTRS:
+            # Swap in a dict of our own, since the caller may modify it.
+            attrs = self._attrs = {}
+        return attrs
+
+    @attrs.setter
+    def attrs(self, attrs):
+        self._attrs = attrs
+
     def __unicode__(self):
         return self.data
 
@@ -211,13 +909,16 @@ class XmlElement (object):
         Returns the child node at the given index.
         """
         if isinstance(idx, basestring):
-            return self.attrs[idx]
+            return self._attrs[idx]
         return self._children[idx]
 
     def __getattr__(self, name):
         """
         Allows access to any attribute or child node directly.
         """
+        if name.startswith('__'):
+            # Special methods looked up by pickle and copy (before any slots are set) are never child nodes.
+            raise AttributeError(name)
         return self.first(name)
 
     def write(self, writer):
@@ -226,14 +927,7 @@ class XmlElement (object):
 
         :param writer: An :class:`XmlWriter` instance to write this node to
         """
-        multiline = bool(self._children)
-        newline_start = multiline and not bool(self.data)
-        writer.start(self.tagname, self.attrs, newline=newline_start)
-        if self.data:
-            writer.data(self.data, newline=bool(self._children))
-        for c in self._children:
-            c.write(writer)
-        writer.end(self.tagname, indent=multiline)
+        writer.serialize(self)
 
     def xml(self, **kwargs):
         """
@@ -245,16 +939,83 @@ class XmlElement (object):
         s = bytes_io()
         writer = XmlWriter(s, **kwargs)
         self.write(writer)
+        writer.flush()
         return s.getvalue()
 
-    def json(self):
-        if self._children:
-            keys = {}
-            for c in self._children:
-                keys.setdefault(c.tagname, []).append(c.json())
-            return {k: v[0] if len(v) == 1 else v for k, v in keys.items()}
-        else:
-            return self.data
+    def json(self, attributes=False, force_list=None):
+        """
+        Returns a JSON-compatible representation of this node (including descendants). Elements without children are
+        represented by their character data, and elements with children by a dict mapping child tag names to values
+        (or lists of values, for tag names that appear more than once).
+
+        :param attributes: If ``True``, include attributes as ``@name`` keys. Elements with attributes are then always
+            represented by a dict, with any character data under a ``#text`` key.
+        :param force_list: A collection of tag names that should always be represented by lists
+        """
+        force_list = frozenset(force_list or ())
+        # Build values bottom up, with a stack of (element, children iterator, {tag: [values]}) for open elements.
+        top = {}
+        stack = [(None, iter((self,)), top)]
+        while stack:
+            parent, children, groups = stack[-1]
+            for c in children:
+                break
+            else:
+                stack.pop()
+                if parent is not None:
+                    value = _json_value(parent, attributes)
+                    for tag, values in groups.items():
+                        value[tag] = values[0] if len(values) == 1 and tag not in force_list else values
+                    if attributes and parent.data:
+                        value['#text'] = parent.data
+                    stack[-1][2].setdefault(parent.tagname, []).append(value)
+                continue
+            if c._children:
+                stack.append((c, iter(c._children), {}))
+            elif attributes and c._attrs:
+                value = _json_value(c, attributes)
+                if c.data:
+                    value['#text'] = c.data
+                groups.setdefault(c.tagname, []).append(value)
+            else:
+                groups.setdefault(c.tagname, []).append(c.data)
+        return top[self.tagname][0]
+
+    def write_json(self, stream, attributes=False, force_list=None, chunk_size=65536):
+        """
+        Writes the JSON representation of this node (see :meth:`json`) to a text stream, without building the
+        intermediate dicts and lists. The output is the same as ``json.dump(self.json(...), stream)``, written in
+        chunks of roughly ``chunk_size`` characters. This works equally well on elements yielded from :func:`iterparse`.
+
+        :param stream: A file-like object with a ``write`` method accepting strings
+        :param attributes: If ``True``, include attributes as ``@name`` keys (see :meth:`json`)
+        :param force_list: A collection of tag names that should always be represented by lists
+        :param chunk_size: The number of characters to buffer between writes to the stream
+        """
+        force_list = frozenset(force_list or ())
+        buf = []
+        size = 0
+        # A stack of iterators over pieces of output: strings are written as-is, and elements are expanded in place.
+        stack = [iter((self,))]
+        while stack:
+            for item in stack[-1]:
+                break
+            else:
+                stack.pop()
+                continue
+            if isinstance(item, XmlElement):
+                if item._children or (attributes and item._attrs):
+                    stack.append(iter(_json_pieces(item, attributes, force_list)))
+                    continue
+                item = _json_string(item.data)
+            buf.append(item)
+            size += len(item)
+            if size >= chunk_size:
+                stream.write(''.join(buf))
+                buf = []
+                size = 0
+        if buf:
+            stream.write(''.join(buf))
 
     def append(self, name, attrs=None, data=None):
         """
@@ -269,6 +1030,9 @@ class XmlElement (object):
         """
         elem = self.__class__(name, attrs, data, parent=self, index=len(self._children))
         self._children.append(elem)
+        if self._index is not None:
+            elem._index = self._index
+            self._invalidate_indexes()
         return elem
 
     def insert(self, before, name, attrs=None, data=None):
@@ -293,6 +1057,9 @@ class XmlElement (object):
         # Re-index all the children.
         for idx, c in enumerate(self._children):
             c.index = idx
+        if self._index is not None:
+            elem._index = self._index
+            self._invalidate_indexes()
         return elem
 
     def clear(self):
@@ -300,16 +1067,46 @@ class XmlElement (object):
         Clears out all children, attributes, and data. Especially useful when using :func:`iterparse`, to release
         memory used by storing attributes, character data, and child nodes.
         """
-        self.attrs = {}
+        self._attrs = _EMPTY_ATTRS
         self.data = ''
         self._children = []
+        if self._index is not None:
+            self._invalidate_indexes()
+
+    def _invalidate_indexes(self):
+        # Invalidates the nearest index, and every index enclosing it.
+        index = self._index
+        while index is not None:
+            index.invalidate()
+            parent = index.root.parent
+            index = parent._index if parent is not None else None
+
+    def save_snapshot(self, path):
+        """
+        Saves this node (including descendants) to a binary snapshot file, which can be loaded much faster than the
+        XML could be parsed, using :func:`load_snapshot`.
+
+        :param path: The filesystem path to write the snapshot to
+        """
+        CompactDocument.from_element(self).save(path)
+
+    def build_index(self, attrs=None):
+        """
+        Creates an :class:`XmlIndex` of this node's descendants, which :meth:`find` and :meth:`iter` (when called on
+        this node) will use automatically. The index is built lazily, the first time it is used.
+
+        :param attrs: A list of ``(tag, attr)`` pairs whose attribute values should also be indexed
+        :rtype: :class:`XmlIndex`
+        """
+        self._index = XmlIndex(self, attrs)
+        return self._index
 
     def items(self):
         """
         A generator yielding ``(key, value)`` attribute pairs, sorted by key name.
         """
-        for key in sorted(self.attrs):
-            yield key, self.attrs[key]
+        for key in sorted(self._attrs):
+            yield key, self._attrs[key]
 
     def children(self, name=None, reverse=False):
         """
@@ -331,48 +1128,7 @@ class XmlElement (object):
         """
         if not pred:
             return True
-        # Strip off the [ and ]
-        pred = pred[1:-1]
-        if pred.startswith('@'):
-            # An attribute predicate checks the existence (and optionally value) of an attribute on this tag.
-            pred = pred[1:]
-            if '=' in pred:
-                attr, value = pred.split('=', 1)
-                if value[0] in ('"', "'"):
-                    value = value[1:]
-                if value[-1] in ('"', "'"):
-                    value = value[:-1]
-                return self.attrs.get(attr) == value
-            else:
-                return pred in self.attrs
-        elif num_re.match(pred):
-            # An index predicate checks whether we are the n-th child of our parent (0-based).
-            index = int(pred)
-            if index < 0:
-                if self.parent:
-                    # For negative indexes, count from the end of the list.
-                    return self.index == (len(self.parent._children) + index)
-                else:
-                    # If we're the root node, the only index we could be is 0.
-                    return index == 0
-            else:
-                return index == self.index
-        else:
-            if '=' in pred:
-                tag, value = pred.split('=', 1)
-                if value[0] in ('"', "'"):
-                    value = value[1:]
-                if value[-1] in ('"', "'"):
-                    value = value[:-1]
-                for c in self._children:
-                    if c.tagname == tag and c.data == value:
-                        return True
-            else:
-                # A plain [tag] predicate means we match if we have a child with tagname "tag".
-                for c in self._children:
-                    if c.tagname == pred:
-                        return True
-        return False
+        return compile_predicate(pred).match(self)
 
     def path(self, include_root=False):
         """
@@ -388,29 +1144,53 @@ class XmlElement (object):
             p = p.parent
         return path
 
-    def find(self, query):
+    def find(self, query, stats=False):
         """
         Recursively find any descendants of this node matching the given query.
 
         :param query: A simplified XPath query describing elements that should be returned, e.g. ``//title``,
-            ``book/*``, ``*/author``, ``*/*``, etc.
+            ``book/*``, ``*/author``, ``*/*``, etc., or a :class:`CompiledQuery` returned by :func:`compile`
+        :param stats: If ``True``, count the nodes visited and predicates evaluated in the returned query's ``stats``
+            (a :class:`QueryStats` object)
         :returns: An :class:`XmlQuery` yielding matching descendants
         """
-        return XmlQuery(self, query)
+        return XmlQuery(self, query, stats)
 
-    def iter(self, name=None):
+    def iter(self, name=None, attrs=None, max_depth=None):
         """
-        Recursively find any descendants of this node with the given tag name. If a tag name is omitted, this will
-        yield every descendant node.
+        Recursively find any descendants of this node with the given tag name, in document order. If a tag name is
+        omitted, this will yield every descendant node.
 
-        :param name: If specified, only consider elements with this tag name
+        :param name: If specified, only consider elements with this tag name (or any tag name in a collection)
+        :param attrs: If specified, only consider elements having this attribute (or every attribute in a collection)
+        :param max_depth: If specified, only descend this many levels below this node (1 yields only children)
         :returns: A generator yielding descendants of this node
         """
-        for c in self._children:
-            if name is None or c.tagname == name:
-                yield c
-            for gc in c.find(name):
-                yield gc
+        if attrs is not None and isinstance(attrs, basestring):
+            attrs = (attrs,)
+        if isinstance(name, basestring) and max_depth is None and self._index is not None and self._index.root is self:
+            # Single tag name lookups can be answered straight from the index.
+            for c in self._index.elements(name):
+                if not attrs or all(a in c._attrs for a in attrs):
+                    yield c
+            return
+        if name is not None and isinstance(name, basestring):
+            name = (name,)
+        elif name is not None:
+            name = frozenset(name)
+        # A flat pre-order walk, using a stack of child iterators rather than recursing.
+        stack = [iter(self._children)]
+        while stack:
+            for c in stack[-1]:
+                break
+            else:
+                stack.pop()
+                continue
+            if name is None or c.tagname in name:
+                if not attrs or all(a in c._attrs for a in attrs):
+                    yield c
+            if c._children and (max_depth is None or len(stack) < max_depth):
+                stack.append(iter(c._children))
 
     def first(self, name=None):
         """
@@ -482,107 +1262,1468 @@ class XmlElement (object):
                 return self.parent[idx]
 
 
-def path_prefix(xpath, path):
-    # TODO: support // descendant queries
-    for idx, p in enumerate(path):
-        if idx >= len(xpath):
-            # Include everything below the last part of the xpath.
-            continue
-        if xpath[idx] not in (p, '*'):
-            return False
-    return True
+def _step_key(step):
+    """
+    Returns a hashable key identifying what a compiled step matches, so identical steps can be shared.
+    """
+    pred = step.predicate
+    if pred is None:
+        return (step.tag, step.deep, None)
+    return (step.tag, step.deep, pred.__class__.__name__) + tuple(getattr(pred, s) for s in pred.__slots__)
 
 
-def path_match(xpath, path):
-    if len(xpath) != len(path):
-        return False
-    return path_prefix(xpath, path)
+class XPathFilter (object):
+    """
+    One or more simplified XPath queries compiled into a small state machine, used by :class:`DrillHandler` to decide
+    at start-tag time which elements need to be built while parsing. Queries are matched against the full path from
+    the document root, and support ``*``, ``//``, and attribute predicates. Other predicates are only supported on the
+    last step, where they are checked once the matching element is complete.
+
+    The queries are merged into a trie of steps, so prefixes shared between queries are only evaluated once. Each open
+    element has a state: a sorted tuple of ``node * 2 + carried`` values, where ``node`` is a trie node whose outgoing
+    steps the element's children may match, and ``carried`` means the node is only active because of a ``//``.
+
+    :param xpath: A query string, or a mapping of names to query strings
+    """
+
+    def __init__(self, xpath):
+        self.named = not isinstance(xpath, (basestring, CompiledQuery))
+        queries = xpath.items() if self.named else [(None, xpath)]
+        # Node 0 is the document itself. For each node: a list of outgoing (step, node) edges, whether any of them are
+        # deep, the names of queries ending at the node, and a predicate to check when an element there is complete.
+        self.edges = [[]]
+        self.deep = [False]
+        self.names = [[]]
+        self.final_predicates = [None]
+        keys = {}
+        for name, query in queries:
+            compiled = compile(query)
+            node = 0
+            for step in compiled.steps:
+                if isinstance(step.predicate, IndexPredicate):
+                    raise ValueError('Index predicates are not supported when filtering while parsing: %r' % compiled.query)
+                if step is not compiled.steps[-1] and isinstance(step.predicate, ChildPredicate):
+                    raise ValueError('Child predicates are only supported on the last step when filtering while parsing: %r' % compiled.query)
+                key = (node,) + _step_key(step)
+                if key not in keys:
+                    keys[key] = len(self.edges)
+                    self.edges[node].append((step, len(self.edges)))
+                    self.deep[node] = self.deep[node] or step.deep
+                    self.edges.append([])
+                    self.deep.append(False)
+                    self.names.append([])
+                    self.final_predicates.append(step.predicate if isinstance(step.predicate, ChildPredicate) else None)
+                node = keys[key]
+            self.names[node].append(name)
+        self.initial = (0,)
+        # Transitions not involving attribute predicates only depend on the state and tag name, so they are cached.
+        self._transitions = {}
+
+    def start(self, state, name, attrs):
+        """
+        Returns a ``(state, advanced, matched)`` tuple for a child element, given the state of its parent. ``advanced``
+        is ``True`` if the element matched a step of any query (as opposed to only being below a ``//``), and
+        ``matched`` is a tuple of the trie nodes where a query ended.
+        """
+        key = (state, name)
+        transition = self._transitions.get(key)
+        if transition is not None:
+            return transition
+        cacheable = True
+        new_state = set()
+        matched = []
+        for value in state:
+            node, carried = value >> 1, value & 1
+            for step, target in self.edges[node]:
+                if carried and not step.deep:
+                    continue
+                if step.tag != '*' and step.tag != name:
+                    continue
+                pred = step.predicate
+                if isinstance(pred, AttributePredicate):
+                    cacheable = False
+                    if not pred.match_attrs(attrs):
+                        continue
+                new_state.add(target * 2)
+                if self.names[target] and target not in matched:
+                    matched.append(target)
+            if self.deep[node]:
+                # Steps after a // may match at any depth, so they stay active for all descendants.
+                new_state.add(node * 2 + 1)
+        transition = (tuple(sorted(new_state)), any(not v & 1 for v in new_state), tuple(matched))
+        if cacheable:
+            self._transitions[key] = transition
+        return transition
+
+    def accept(self, matched, element):
+        """
+        Returns a list of the names of queries matched by a completed element, checking any predicate on the last step
+        that could not be checked at start-tag time.
+        """
+        names = []
+        for node in matched:
+            pred = self.final_predicates[node]
+            if pred is None or pred.match(element):
+                names.extend(self.names[node])
+        return names
+
+
+class ParseStats (object):
+    """
+    Counters for the work done while parsing. Pass an instance to :func:`parse`, :func:`iterparse`, or
+    :class:`DrillParser` to enable counting, which wraps the handler's expat callbacks (so there's no cost when it's
+    disabled). It is also available as the handler's ``stats`` attribute.
+
+    * ``bytes_fed``: bytes of XML passed to expat
+    * ``elements``: start tags seen
+    * ``elements_created``: elements built by the handler
+    * ``elements_skipped``: elements skipped without being built, because they can't match the xpath filter
+    * ``cdata_fragments``: pieces of character data joined into element data
+    * ``queue_high_water``: the largest number of elements pending in an iterparse or :class:`DrillParser` queue
+    """
+
+    def __init__(self):
+        self.bytes_fed = 0
+        self.elements = 0
+        self.elements_created = 0
+        self.elements_skipped = 0
+        self.cdata_fragments = 0
+        self.queue_high_water = 0
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ' '.join('%s=%s' % item for item in sorted(self.as_dict().items())))
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def queued(self, pending):
+        if pending > self.queue_high_water:
+            self.queue_high_water = pending
+
+    def instrument(self, parser, handler):
+        """
+        Replaces the element and character data callbacks of an expat parser with ones that count into these stats.
+        Subclasses may override this to add their own hooks.
+        """
+        start_element, characters = handler.start_element, handler.characters
+        stats = self
+
+        def counting_start_element(name, attrs):
+            start_element(name, attrs)
+            stats.elements += 1
+            # Handlers filtering on an xpath record whether each open element was built.
+            if getattr(handler, 'xpath', None) is None or handler.stack[-1][1]:
+                stats.elements_created += 1
+            else:
+                stats.elements_skipped += 1
+
+        def counting_characters(ch):
+            cdata = handler.cdata
+            count = len(cdata)
+            characters(ch)
+            if handler.cdata is cdata:
+                stats.cdata_fragments += len(cdata) - count
+
+        parser.StartElementHandler = counting_start_element
+        parser.CharacterDataHandler = counting_characters
+
+
+class _CountingReader (object):
+    """
+    Wraps a file-like object, counting the bytes read from it into a :class:`ParseStats`.
+    """
+
+    def __init__(self, filelike, stats):
+        self.filelike = filelike
+        self.stats = stats
+
+    def read(self, size=-1):
+        data = self.filelike.read(size)
+        self.stats.bytes_fed += len(data)
+        return data
 
 
 class DrillHandler (object):
     element_class = XmlElement
 
-    def __init__(self, queue=None, xpath=None):
+    def __init__(self, queue=None, xpath=None, intern_values=False):
         self.root = None
         self.current = None
         # Store character data in the parse handler instead of each element, to save memory.
         self.cdata = []
+        # Expat interns tag and attribute names in this dict, so each distinct name is only stored once per parse. With
+        # intern_values, repeated attribute values are interned here as well.
+        self.intern = {}
+        self.intern_values = intern_values
         # This is for iterparse - feed the elements to a queue as they are parsed.
         self.queue = queue
         # In case we only want to parse elements matching an xpath.
-        self.xpath = parse_query(xpath) if xpath else None
+        self.xpath = XPathFilter(xpath) if xpath else None
         self.path = []
+        # When filtering, a stack of (state, built, inside, matched) for each open element. Elements are only built
+        # when they are the document root, they match a step of the xpath, or they are inside a matching element.
+        self.stack = []
+        # A ParseStats object, if counting is enabled.
+        self.stats = None
 
     def start_element(self, name, attrs):
         self.path.append(name)
-        if self.xpath and not path_prefix(self.xpath, self.path):
-            # No need to deal with elements outside our xpath.
-            return
-        elif self.root is None:
+        if self.xpath is not None:
+            if self.stack:
+                state, built, inside, matched = self.stack[-1]
+                inside = inside or matched
+                if not state and not inside:
+                    # No need to deal with elements outside our xpath.
+                    self.stack.append(((), False, False, False))
+                    return
+            else:
+                state, inside = self.xpath.initial, False
+            state, advanced, matched = self.xpath.start(state, name, attrs)
+            build = inside or advanced or not self.stack
+            self.stack.append((state, build, inside, matched))
+            if not build:
+                return
+        if self.intern_values and attrs:
+            intern = self.intern
+            for k, v in attrs.items():
+                attrs[k] = intern.setdefault(v, v)
+        if self.root is None:
             self.root = self.element_class(name, attrs)
             self.current = self.root
         elif self.current is not None:
             self.current = self.current.append(name, attrs)
 
     def end_element(self, name):
-        if self.xpath and not path_prefix(self.xpath, self.path):
-            # No need to deal with elements outside our xpath, fall through so path is popped.
-            pass
-        elif self.current is not None:
+        if self.xpath is not None:
+            state, built, inside, matched = self.stack.pop()
+            if not built:
+                # Skipped elements were never built, fall through so path is popped.
+                assert self.path.pop() == name
+                return
+        else:
+            matched = True
+        if self.current is not None:
             self.current.data = ''.join(self.cdata).strip()
             self.cdata = []
-            if self.queue and (self.xpath is None or path_match(self.xpath, self.path)):
-                # Only queue exact xpath matches.
-                self.queue.add(self.current)
+            if self.queue and matched:
+                if self.xpath is None:
+                    self.queue.add(self.current)
+                elif self.xpath.named:
+                    # Queue a (name, element) pair for each matching subscription.
+                    for match in self.xpath.accept(matched, self.current):
+                        self.queue.add((match, self.current))
+                elif self.xpath.accept(matched, self.current):
+                    # Only queue exact xpath matches.
+                    self.queue.add(self.current)
             self.current = self.current.parent
         # TODO: failure indicates malformed XML - is this a fatal error, or should we just pop?
         assert self.path.pop() == name
 
     def characters(self, ch):
-        if self.xpath and not path_prefix(self.xpath, self.path):
+        if self.xpath is not None and not (self.stack and self.stack[-1][1]):
             return
         if self.current is not None:
             self.cdata.append(unicode(ch))
 
 
-def parse(url_or_path, encoding=None, handler_class=DrillHandler):
+SNAPSHOT_MAGIC = b'DRILLSNP'
+SNAPSHOT_VERSION = 1
+
+
+class CompactDocument (object):
     """
-    :param url_or_path: A file-like object, a filesystem path, a URL, or a string containing XML
-    :rtype: :class:`XmlElement`
+    A read-only document stored as parallel arrays instead of one :class:`XmlElement` per node. Tag names and attribute
+    names are interned into a string table, the tree structure is stored as parent, first child, and next sibling node
+    numbers, and character data and attribute values are stored as UTF-8 in two shared buffers. Nodes are numbered in
+    document order, with the root element as node 0.
+
+    Use :meth:`element` (or :attr:`root`) to get a :class:`CompactElement` for a node, which supports the read-only parts
+    of the :class:`XmlElement` API.
     """
-    handler = handler_class()
-    parser = expat.ParserCreate(encoding)
-    parser.buffer_text = 1
-    parser.StartElementHandler = handler.start_element
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        # Per-node arrays.
+        self.tags = array.array('i')
+        self.parents = array.array('i')
+        self.first_children = array.array('i')
+        self.next_siblings = array.array('i')
+        self.indexes = array.array('i')
+        self.text_offsets = array.array(OFFSET_TYPECODE)
+        self.text_lengths = array.array('i')
+        self.attr_offsets = array.array('i')
+        # Per-attribute arrays. Attribute values for node i are attr_keys[attr_offsets[i]:attr_offsets[i + 1]].
+        self.attr_keys = array.array('i')
+        self.value_offsets = array.array(OFFSET_TYPECODE, [0])
+        self.text = bytearray()
+        self.values = bytearray()
+        # The memory map of a snapshot file, if the arrays above are views of one.
+        self.map = None
+        # The last child of each node, computed the first time it's needed.
+        self._last_children = None
+
+    def __len__(self):
+        return len(self.tags)
+
+    def string_id(self, s):
+        try:
+            return self.string_ids[s]
+        except KeyError:
+            sid = self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+            return sid
+
+    @property
+    def root(self):
+        """
+        The root element of the document, or ``None`` if the document is empty.
+        """
+        return self.element(0) if self.tags else None
+
+    def element(self, node):
+        """
+        Returns a :class:`CompactElement` for the given node number.
+        """
+        return CompactElement(self, node)
+
+    def children(self, node):
+        """
+        Returns a list of the child node numbers of a node.
+        """
+        children = []
+        child = self.first_children[node]
+        next_siblings = self.next_siblings
+        while child >= 0:
+            children.append(child)
+            child = next_siblings[child]
+        return children
+
+    def last_child(self, node):
+        """
+        Returns the node number of the last child of a node, or -1 if it has no children.
+        """
+        if self._last_children is None:
+            last_children = array.array('i', [-1]) * len(self.tags)
+            # Children are numbered in document order, so the last one seen for each parent is its last child.
+            for child, parent in enumerate(self.parents):
+                if parent >= 0:
+                    last_children[parent] = child
+            self._last_children = last_children
+        return self._last_children[node]
+
+    def previous_sibling(self, node):
+        """
+        Returns the node number of the previous sibling of a node, or -1 if it is the first child.
+        """
+        parent = self.parents[node]
+        if parent < 0 or self.first_children[parent] == node:
+            return -1
+        # The node before this one is the previous sibling, or the last of its descendants.
+        parents = self.parents
+        sibling = node - 1
+        while parents[sibling] != parent:
+            sibling = parents[sibling]
+        return sibling
+
+    def child_count(self, node):
+        """
+        Returns the number of children of a node.
+        """
+        last = self.last_child(node)
+        return 0 if last < 0 else self.indexes[last] + 1
+
+    def data(self, node):
+        start = self.text_offsets[node]
+        # The buffers may be memoryviews of a snapshot, which have no decode method.
+        return unicode(self.text[start:start + self.text_lengths[node]], 'utf-8')
+
+    def attrs(self, node):
+        start = self.attr_offsets[node]
+        end = self.attr_offsets[node + 1] if node + 1 < len(self.attr_offsets) else len(self.attr_keys)
+        attrs = {}
+        for a in xrange(start, end):
+            value = unicode(self.values[self.value_offsets[a]:self.value_offsets[a + 1]], 'utf-8')
+            attrs[self.strings[self.attr_keys[a]]] = value
+        return attrs
+
+    @classmethod
+    def from_element(cls, element):
+        """
+        Builds a document from an :class:`XmlElement` and its descendants.
+        """
+        handler = CompactHandler()
+        handler.start_element(element.tagname, element._attrs)
+        stack = [(element, iter(element._children))]
+        while stack:
+            elem, children = stack[-1]
+            for child in children:
+                handler.start_element(child.tagname, child._attrs)
+                stack.append((child, iter(child._children)))
+                break
+            else:
+                # Character data is only collected at the end of each element, after its children have ended.
+                if elem.data:
+                    handler.characters(elem.data)
+                handler.end_element(elem.tagname)
+                stack.pop()
+        return handler.document
+
+    def to_element(self, element_class=XmlElement):
+        """
+        Builds an :class:`XmlElement` tree from this document, and returns its root.
+        """
+        # Plain lists and bytes are much faster to index and slice than arrays or memoryviews.
+        strings = self.strings
+        tags, parents, indexes = self.tags.tolist(), self.parents.tolist(), self.indexes.tolist()
+        text_offsets, text_lengths = self.text_offsets.tolist(), self.text_lengths.tolist()
+        attr_offsets = self.attr_offsets.tolist() + [len(self.attr_keys)]
+        attr_keys, value_offsets = self.attr_keys.tolist(), self.value_offsets.tolist()
+        text, values = bytes(self.text), bytes(self.values)
+        elements = []
+        # Nothing built here can be garbage, so don't let the cyclic garbage collector repeatedly scan the growing tree.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for node in xrange(len(tags)):
+                parent = parents[node]
+                if parent < 0:
+                    elem = element_class(strings[tags[node]])
+                else:
+                    parent = elements[parent]
+                    elem = element_class(strings[tags[node]], parent=parent, index=indexes[node])
+                    parent._children.append(elem)
+                start, end = attr_offsets[node], attr_offsets[node + 1]
+                if start != end:
+                    attrs = elem._attrs = {}
+                    for a in xrange(start, end):
+                        attrs[strings[attr_keys[a]]] = values[value_offsets[a]:value_offsets[a + 1]].decode('utf-8')
+                length = text_lengths[node]
+                if length:
+                    start = text_offsets[node]
+                    elem.data = text[start:start + length].decode('utf-8')
+                elements.append(elem)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return elements[0] if elements else None
+
+    # The order of the sections of a snapshot file, after the header.
+    SNAPSHOT_SECTIONS = (
+        ('tags', 'i'), ('parents', 'i'), ('first_children', 'i'), ('next_siblings', 'i'), ('indexes', 'i'),
+        ('text_offsets', 'q'), ('text_lengths', 'i'), ('attr_offsets', 'i'), ('attr_keys', 'i'),
+        ('value_offsets', 'q'), ('text', 'B'), ('values', 'B'), ('strings', 'B'),
+    )
+
+    def save(self, path):
+        """
+        Saves this document to a snapshot file, which can be loaded with :func:`load_snapshot`. Snapshots store the
+        document's arrays as they are in memory (little-endian), so loading them doesn't involve any parsing. The file
+        is written under a temporary name and then renamed, so processes that have the old snapshot mapped are not
+        affected.
+        """
+        sections = []
+        for name, typecode in self.SNAPSHOT_SECTIONS:
+            if name == 'strings':
+                data = b'\0'.join(s.encode('utf-8') for s in self.strings)
+            else:
+                data = getattr(self, name)
+                if typecode != 'B' and sys.byteorder == 'big':
+                    data = array.array(OFFSET_TYPECODE if typecode == 'q' else typecode, data)
+                    data.byteswap()
+            sections.append(data)
+        header_size = len(SNAPSHOT_MAGIC) + 8 + 16 * len(sections)
+        offsets = []
+        offset = header_size
+        for data in sections:
+            # Align each section to 8 bytes, so it can be cast to an array in place.
+            offset += -offset % 8
+            offsets.append((offset, memoryview(data).nbytes))
+            offset += offsets[-1][1]
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC)
+                f.write(struct.pack('<II', SNAPSHOT_VERSION, len(sections)))
+                for offset, size in offsets:
+                    f.write(struct.pack('<QQ', offset, size))
+                for (offset, size), data in zip(offsets, sections):
+                    f.write(b'\0' * (offset - f.tell()))
+                    f.write(data)
+            getattr(os, 'replace', os.rename)(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @classmethod
+    def _snapshot_sections(cls, path, data):
+        """
+        Validates the header of snapshot file data, and returns the ``(offset, size)`` of each section, raising
+        ``ValueError`` if the data isn't a snapshot or is truncated.
+        """
+        magic_size = len(SNAPSHOT_MAGIC)
+        header_size = magic_size + 8
+        if len(data) < header_size or data[:magic_size] != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a drill snapshot.' % path)
+        version, count = struct.unpack_from('<II', data, magic_size)
+        if version != SNAPSHOT_VERSION or count != len(cls.SNAPSHOT_SECTIONS):
+            raise ValueError('Unsupported snapshot version: %s' % version)
+        header_size += 16 * count
+        if len(data) < header_size:
+            raise ValueError('%s is a truncated drill snapshot.' % path)
+        sections = []
+        for i, (name, typecode) in enumerate(cls.SNAPSHOT_SECTIONS):
+            offset, size = struct.unpack_from('<QQ', data, magic_size + 8 + 16 * i)
+            if offset < header_size or offset + size > len(data) or size % struct.calcsize('<' + typecode):
+                raise ValueError('%s is a truncated drill snapshot.' % path)
+            sections.append((offset, size))
+        return sections
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a document from a snapshot file. The file is memory-mapped, and the document's arrays are views of the
+        mapping, so the operating system shares its pages between every process that loads it.
+        """
+        with open(path, 'rb') as f:
+            data = map_file(f)
+        view = memoryview(data)
+        try:
+            sections = cls._snapshot_sections(path, data)
+        except ValueError:
+            # Don't leave the file mapped when it can't be loaded.
+            if PY3:
+                view.release()
+            if isinstance(data, mmap.mmap):
+                data.close()
+            raise
+        doc = cls()
+        doc.map = data
+        for (name, typecode), (offset, size) in zip(cls.SNAPSHOT_SECTIONS, sections):
+            section = view[offset:offset + size]
+            if name == 'strings':
+                doc.strings = [s.decode('utf-8') for s in section.tobytes().split(b'\0')] if size else []
+                doc.string_ids = dict((s, sid) for sid, s in enumerate(doc.strings))
+            elif typecode == 'B':
+                setattr(doc, name, section)
+            elif PY3 and sys.byteorder == 'little':
+                setattr(doc, name, section.cast(typecode))
+            else:
+                # Copy the section into an array, since memoryview.cast is Python 3 only, and the byte order differs.
+                values = array.array(OFFSET_TYPECODE if typecode == 'q' else typecode)
+                if PY3:
+                    values.frombytes(section.tobytes())
+                else:
+                    values.fromstring(section.tobytes())
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                setattr(doc, name, values)
+        return doc
+
+
+class CompactElement (XmlElement):
+    """
+    A lightweight, read-only proxy for a node of a :class:`CompactDocument`, supporting the same traversal, query, and
+    serialization methods as :class:`XmlElement`. Proxies are created on demand, so two proxies for the same node are
+    equal but not necessarily identical.
+    """
+
+    __slots__ = ('document', 'node')
+
+    def __init__(self, document, node):
+        self.document = document
+        self.node = node
+
+    def __eq__(self, other):
+        return isinstance(other, CompactElement) and other.document is self.document and other.node == self.node
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.document), self.node))
+
+    @property
+    def tagname(self):
+        return self.document.strings[self.document.tags[self.node]]
+
+    @property
+    def parent(self):
+        parent = self.document.parents[self.node]
+        return None if parent < 0 else CompactElement(self.document, parent)
+
+    @property
+    def index(self):
+        return self.document.indexes[self.node]
+
+    @property
+    def attrs(self):
+        return self.document.attrs(self.node)
+
+    _attrs = attrs
+
+    @property
+    def data(self):
+        return self.document.data(self.node)
+
+    @property
+    def _children(self):
+        doc = self.document
+        return [CompactElement(doc, c) for c in doc.children(self.node)]
+
+    def __len__(self):
+        return self.document.child_count(self.node)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, basestring):
+            return self.attrs[idx]
+        if isinstance(idx, slice):
+            return self._children[idx]
+        # Walk the sibling links from whichever end the index counts from, rather than building every child.
+        doc = self.document
+        if idx < 0:
+            child, steps, step = doc.last_child(self.node), -1 - idx, doc.previous_sibling
+        else:
+            child, steps, step = doc.first_children[self.node], idx, doc.next_siblings.__getitem__
+        while child >= 0 and steps:
+            child = step(child)
+            steps -= 1
+        if child < 0:
+            raise IndexError('child index out of range')
+        return CompactElement(doc, child)
+
+    def children(self, name=None, reverse=False):
+        doc = self.document
+        if reverse:
+            child, step = doc.last_child(self.node), doc.previous_sibling
+        else:
+            child, step = doc.first_children[self.node], doc.next_siblings.__getitem__
+        while child >= 0:
+            if name is None or doc.strings[doc.tags[child]] == name:
+                yield CompactElement(doc, child)
+            child = step(child)
+
+    def next(self, name=None):
+        doc = self.document
+        sibling = doc.next_siblings[self.node]
+        while sibling >= 0:
+            if name is None or doc.strings[doc.tags[sibling]] == name:
+                return CompactElement(doc, sibling)
+            sibling = doc.next_siblings[sibling]
+
+    def prev(self, name=None):
+        doc = self.document
+        sibling = doc.previous_sibling(self.node)
+        while sibling >= 0:
+            if name is None or doc.strings[doc.tags[sibling]] == name:
+                return CompactElement(doc, sibling)
+            sibling = doc.previous_sibling(sibling)
+
+    @property
+    def _index(self):
+        return None
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s objects are read-only.' % self.__class__.__name__)
+
+    def save_snapshot(self, path):
+        if self.node == 0:
+            # The document is already in snapshot form.
+            self.document.save(path)
+        else:
+            super(CompactElement, self).save_snapshot(path)
+
+    append = insert = clear = build_index = _read_only
+
+
+class CompactHandler (object):
+    """
+    A parse handler that builds a :class:`CompactDocument`.
+    """
+
+    def __init__(self):
+        self.document = CompactDocument()
+        self.cdata = []
+        # The open nodes, and the last child seen so far of each.
+        self.stack = []
+        self.last_child = []
+
+    def start_element(self, name, attrs):
+        doc = self.document
+        node = len(doc.tags)
+        doc.tags.append(doc.string_id(name))
+        doc.first_children.append(-1)
+        doc.next_siblings.append(-1)
+        if self.stack:
+            parent = self.stack[-1]
+            last = self.last_child[-1]
+            if last < 0:
+                doc.first_children[parent] = node
+                doc.indexes.append(0)
+            else:
+                doc.next_siblings[last] = node
+                doc.indexes.append(doc.indexes[last] + 1)
+            self.last_child[-1] = node
+        else:
+            parent = -1
+            doc.indexes.append(0)
+        doc.parents.append(parent)
+        doc.attr_offsets.append(len(doc.attr_keys))
+        for k, v in attrs.items():
+            doc.attr_keys.append(doc.string_id(k))
+            doc.values.extend(v.encode('utf-8'))
+            doc.value_offsets.append(len(doc.values))
+        # Character data is only known once the element ends.
+        doc.text_offsets.append(0)
+        doc.text_lengths.append(0)
+        self.stack.append(node)
+        self.last_child.append(-1)
+
+    def end_element(self, name):
+        doc = self.document
+        node = self.stack.pop()
+        self.last_child.pop()
+        data = ''.join(self.cdata).strip()
+        self.cdata = []
+        if data:
+            data = data.encode('utf-8')
+            doc.text_offsets[node] = len(doc.text)
+            doc.text_lengths[node] = len(data)
+            doc.text.extend(data)
+
+    def characters(self, ch):
+        if self.stack:
+            self.cdata.append(ch)
+
+
+def create_parser(handler, encoding=None):
+    """
+    Creates an expat parser that sends events to the given handler. If the handler has an ``intern`` dict, expat will
+    use it to intern tag and attribute names.
+    """
+    intern = getattr(handler, 'intern', None)
+    if intern is None:
+        parser = expat.ParserCreate(encoding)
+    else:
+        parser = expat.ParserCreate(encoding, intern=intern)
+    parser.buffer_text = 1
+    parser.StartElementHandler = handler.start_element
     parser.EndElementHandler = handler.end_element
     parser.CharacterDataHandler = handler.characters
+    stats = getattr(handler, 'stats', None)
+    if stats is not None:
+        stats.instrument(parser, handler)
+    return parser
+
+
+_children_slot = XmlElement.__dict__['_children']
+_data_slot = XmlElement.__dict__['data']
+
+
+class LazyXmlElement (XmlElement):
+    """
+    An element whose children and character data are parsed from a :class:`LazySource` the first time they are
+    accessed. Used for the top-level children of documents parsed with ``parse(..., lazy=True)``.
+    """
+
+    __slots__ = ('_source', '_span')
+
+    def __init__(self, name, attrs=None, source=None, span=None, parent=None, index=None):
+        # Make sure _source is set before XmlElement.__init__ touches any of the lazy properties.
+        self._source = None
+        super(LazyXmlElement, self).__init__(name, attrs, parent=parent, index=index)
+        self._source = source
+        self._span = span
+
+    def _load(self):
+        source, (start, end) = self._source, self._span
+        self._source = None
+        self._span = None
+        root = source.parse(start, end)
+        for c in root._children:
+            c.parent = self
+        _children_slot.__set__(self, root._children)
+        _data_slot.__set__(self, root.data)
+
+    @property
+    def loaded(self):
+        """
+        Whether this element's subtree has been parsed yet.
+        """
+        return self._source is None
+
+    @property
+    def _children(self):
+        if self._source is not None:
+            self._load()
+        return _children_slot.__get__(self, XmlElement)
+
+    @_children.setter
+    def _children(self, children):
+        _children_slot.__set__(self, children)
+
+    @property
+    def data(self):
+        if self._source is not None:
+            self._load()
+        return _data_slot.__get__(self, XmlElement)
+
+    @data.setter
+    def data(self, data):
+        _data_slot.__set__(self, data)
+
+    def clear(self):
+        self._source = None
+        self._span = None
+        super(LazyXmlElement, self).clear()
+
+
+_lazy_classes = {XmlElement: LazyXmlElement}
+
+
+def lazy_element_class(element_class):
+    """
+    Returns a subclass of both :class:`LazyXmlElement` and the given element class, so lazily loaded elements are still
+    instances of a custom element class. Falls back to :class:`LazyXmlElement` if the two can't be combined (for
+    instance, if the custom class defines its own ``__slots__``).
+    """
+    try:
+        return _lazy_classes[element_class]
+    except KeyError:
+        try:
+            cls = type('Lazy' + element_class.__name__, (LazyXmlElement, element_class), {'__slots__': ()})
+        except TypeError:
+            cls = LazyXmlElement
+        _lazy_classes[element_class] = cls
+        return cls
+
+
+class LazySource (object):
+    """
+    The bytes of a lazily parsed document (possibly memory-mapped), used to parse subtrees on demand.
+    """
+
+    def __init__(self, data, encoding=None, handler_class=DrillHandler):
+        self.data = data
+        self.encoding = encoding
+        self.handler_class = handler_class
+
+    def parse(self, start, end):
+        """
+        Parses the element at ``data[start:end]``, and returns it.
+        """
+        handler = self.handler_class()
+        parser = create_parser(handler, self.encoding)
+        parser.Parse(self.data[start:end], True)
+        return handler.root
+
+
+class LazyHandler (object):
+    """
+    A parse handler that builds the root element of a document, and a :class:`LazyXmlElement` for each of its children
+    recording the byte range of the child, without building anything below them.
+    """
+
+    def __init__(self, source, element_class=XmlElement):
+        self.source = source
+        self.parser = None
+        self.element_class = element_class
+        self.lazy_class = lazy_element_class(element_class)
+        self.root = None
+        self.cdata = []
+        self.depth = 0
+        self.start = None
+        # Whether the current top-level child has any content, which is needed to find the end of empty elements.
+        self.content = False
+
+    def xml_decl(self, version, encoding, standalone):
+        # Subtrees are parsed without the XML declaration, so remember the document's encoding for them.
+        if encoding and self.source.encoding is None:
+            self.source.encoding = encoding
+
+    def start_element(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1:
+            self.root = self.element_class(name, attrs)
+        elif self.depth == 2:
+            self.start = self.parser.CurrentByteIndex
+            self.content = False
+            elem = self.lazy_class(name, attrs, parent=self.root, index=len(self.root._children))
+            self.root._children.append(elem)
+        else:
+            self.content = True
+
+    def end_element(self, name):
+        self.depth -= 1
+        if self.depth == 0:
+            self.root.data = ''.join(self.cdata).strip()
+        elif self.depth == 1:
+            data = self.source.data
+            pos = self.parser.CurrentByteIndex
+            if pos == self.start:
+                # Some versions of expat report empty elements at their start.
+                end = start_tag_re.match(data, pos).end()
+            elif not self.content and data[pos - 2:pos] == b'/>':
+                # Others report them at their end.
+                end = pos
+            else:
+                # Otherwise we're at the start of the end tag.
+                end = data.find(b'>', pos) + 1
+            elem = self.root._children[-1]
+            elem._source = self.source
+            elem._span = (self.start, end)
+
+    def characters(self, ch):
+        if self.depth == 1:
+            self.cdata.append(ch)
+        elif self.depth > 1:
+            self.content = True
+
+
+def map_file(f):
+    """
+    Returns a read-only memory map of an open file, or its contents if it can't be mapped (for instance if it's empty).
+    """
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        f.seek(0)
+        return f.read()
+
+
+MMAP_CHUNK_SIZE = 1048576
+
+
+class MappedFile (object):
+    """
+    A read-only file-like object over a memory-mapped file. Its ``read`` method returns memoryview slices of the
+    mapping rather than copying the data into new bytes objects.
+    """
+
+    def __init__(self, f):
+        self.map = map_file(f)
+        self.view = memoryview(self.map)
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, size=-1):
+        start = self.pos
+        end = len(self.view) if size is None or size < 0 else min(start + size, len(self.view))
+        self.pos = end
+        return self.view[start:end]
+
+    def close(self):
+        try:
+            self.view.release()
+            if isinstance(self.map, mmap.mmap):
+                self.map.close()
+        except BufferError:
+            # Someone is still holding a slice, the mapping will be closed when it's garbage collected.
+            pass
+
+
+def parse_mapped(parser, f, chunk_size=None):
+    """
+    Memory-maps an open file, and feeds it to an expat parser in slices of ``chunk_size`` bytes without copying.
+    Returns the number of bytes parsed.
+    """
+    source = MappedFile(f)
+    chunk_size = chunk_size or MMAP_CHUNK_SIZE
+    try:
+        while True:
+            with source.read(chunk_size) as chunk:
+                parser.Parse(chunk, False)
+            if source.pos >= len(source):
+                parser.Parse(b'', True)
+                return len(source)
+    finally:
+        source.close()
+
+
+class HTTPResponseReader (object):
+    """
+    A file-like object for reading the body of a response from an :class:`HTTPConnectionPool`, decompressing it as it
+    is read if the server sent it gzip-encoded. The connection is returned to the pool once the body has been read to
+    the end and the reader is closed.
+    """
+
+    # The number of compressed bytes read from the connection at a time.
+    READ_SIZE = 16384
+
+    def __init__(self, pool, key, connection, response, url):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.msg
+        encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+        # 16 + MAX_WBITS tells zlib to expect a gzip header and trailer.
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding in ('gzip', 'x-gzip') else None
+        self._tail = b''
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self, size=-1):
+        if self.connection is None:
+            return b''
+        if self.decompressor is None:
+            data = self.response.read() if size is None or size < 0 else self.response.read(size)
+            if not data:
+                self.close()
+            return data
+        if size is None or size < 0:
+            data = self.decompressor.decompress(self._tail + self.response.read()) + self.decompressor.flush()
+            self._tail = b''
+            self.close()
+            return data
+        while True:
+            if self._tail:
+                data = self.decompressor.decompress(self._tail, size)
+            else:
+                compressed = self.response.read(self.READ_SIZE)
+                if not compressed:
+                    data = self.decompressor.flush()
+                    self.close()
+                    return data
+                data = self.decompressor.decompress(compressed, size)
+            self._tail = self.decompressor.unconsumed_tail
+            if data:
+                return data
+
+    def close(self):
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            # The whole body was read, so the connection can be used for another request.
+            self.pool.release(self.key, connection)
+        else:
+            self.response.close()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HTTPConnectionPool (object):
+    """
+    A thread-safe pool of persistent HTTP and HTTPS connections, which asks for gzip-encoded responses and decompresses
+    them as they are read. :func:`parse`, :func:`iterparse`, and :class:`ParseCache` fetch ``http://`` and ``https://``
+    URLs through the module-level ``http_pool``. Requests that should go through a proxy (according to the
+    ``http_proxy``, ``https_proxy``, and ``no_proxy`` environment variables, or the system settings) are made with
+    urllib instead, without pooling or decompression.
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, max_idle=4, timeout=None, headers=None):
+        """
+        :param max_idle: The maximum number of idle connections to keep per host
+        :param timeout: The socket timeout for new connections, in seconds
+        :param headers: Extra headers to send with every request
+        """
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.headers = {'Accept-Encoding': 'gzip', 'User-Agent': 'drill/%s' % __version__}
+        self.headers.update(headers or {})
+        # Idle connections for each (scheme, host, port).
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        Returns an idle connection for a (scheme, host, port) key, and whether it was reused.
+        """
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        connection_class = http_client.HTTPSConnection if scheme == 'https' else http_client.HTTPConnection
+        if self.timeout is None:
+            return connection_class(host, port), False
+        return connection_class(host, port, timeout=self.timeout), False
+
+    def release(self, key, connection):
+        """
+        Returns a connection to the pool, once its last response has been read.
+        """
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """
+        Closes every idle connection.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def open(self, url, headers=None):
+        """
+        Sends a GET request for a URL, following redirects, and returns an :class:`HTTPResponseReader` for the body.
+        Responses other than 2xx raise an ``HTTPError``, like ``urlopen``.
+
+        :param headers: Extra headers to send with this request
+        """
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        for i in xrange(self.MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if _proxied(parts.scheme, parts.hostname):
+                # The pool only makes direct connections, so let urllib handle proxied requests (with a new opener, so
+                # it sees the current proxy settings, as this check does).
+                return url_lib.build_opener().open(url_lib.Request(url, headers=request_headers))
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            connection, reused = self.acquire(key)
+            try:
+                connection.request('GET', path, headers=request_headers)
+                response = connection.getresponse()
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+                # The server may have closed an idle connection, so try again on a new one.
+                connection, reused = self.acquire(key)
+                connection.request('GET', path, headers=request_headers)
+                response = connection.getresponse()
+            reader = HTTPResponseReader(self, key, connection, response, url)
+            if 200 <= response.status < 300:
+                return reader
+            location = response.getheader('Location')
+            body = reader.read()
+            reader.close()
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            raise url_lib.HTTPError(url, response.status, response.reason, response.msg, bytes_io(body))
+        raise url_lib.HTTPError(url, response.status, 'Too many redirects', response.msg, bytes_io(b''))
+
+
+def _proxied(scheme, host):
+    """
+    Returns whether urllib would send a request for the given scheme and host through a proxy.
+    """
+    return scheme in url_lib.getproxies() and not url_lib.proxy_bypass(host)
+
+
+http_pool = HTTPConnectionPool()
+
+
+def open_url(url, headers=None):
+    """
+    Opens a URL for reading. HTTP and HTTPS URLs are fetched through ``http_pool``, and others with ``urlopen``.
+    """
+    if url.split('://', 1)[0].lower() in ('http', 'https'):
+        return http_pool.open(url, headers)
+    return url_lib.urlopen(url_lib.Request(url, headers=headers or {}))
+
+
+def _parse_lazy(url_or_path, encoding, handler_class):
+    if isinstance(url_or_path, basestring):
+        if '://' in url_or_path[:20]:
+            with contextlib.closing(open_url(url_or_path)) as f:
+                data = f.read()
+        elif url_or_path[:100].strip().startswith('<'):
+            data = url_or_path.encode(encoding or 'utf-8') if isinstance(url_or_path, unicode) else url_or_path
+        else:
+            with open(url_or_path, 'rb') as f:
+                data = map_file(f)
+    elif PY3 and isinstance(url_or_path, (bytes, bytearray, mmap.mmap)):
+        data = url_or_path
+    elif hasattr(url_or_path, 'fileno'):
+        data = map_file(url_or_path)
+    else:
+        data = url_or_path.read()
+    source = LazySource(data, encoding, handler_class)
+    handler = LazyHandler(source, handler_class.element_class)
+    parser = create_parser(handler, encoding)
+    parser.XmlDeclHandler = handler.xml_decl
+    handler.parser = parser
+    parser.Parse(data, True)
+    return handler.root
+
+
+def parse(url_or_path, encoding=None, handler_class=DrillHandler, index=None, compact=False, intern_values=False,
+          lazy=False, use_mmap=False, chunk_size=None, stats=None):
+    """
+    :param url_or_path: A file-like object, a filesystem path, a URL, or a string containing XML. HTTP and HTTPS URLs
+        are fetched through the ``http_pool`` :class:`HTTPConnectionPool`.
+    :param index: If ``True``, build an :class:`XmlIndex` of the parsed document's tag names. May also be a list of
+        ``(tag, attr)`` pairs whose attribute values should be indexed as well.
+    :param compact: If ``True``, store the document as a read-only :class:`CompactDocument`, which uses much less
+        memory, and return its root :class:`CompactElement`. The ``handler_class`` is not used.
+    :param intern_values: If ``True``, share a single string between all equal attribute values (tag and attribute
+        names are always shared), which saves memory when attribute values are highly repetitive
+    :param lazy: If ``True``, only the root element and its immediate children (with their attributes) are built up
+        front. Each child's subtree is parsed from its recorded byte range the first time its children or data are
+        accessed. Files are memory-mapped, so untouched parts of the document are never read into memory. Subtrees
+        are parsed on their own, so this does not work with entities declared in a DTD. Cannot be combined with
+        ``index``, ``compact``, ``intern_values``, ``use_mmap``, ``chunk_size``, or ``stats``.
+    :param use_mmap: If ``True``, memory-map files (filesystem paths, or file objects with a ``fileno``) and feed them
+        to the parser directly from the mapping, rather than reading them into a buffer
+    :param chunk_size: With ``use_mmap``, the number of bytes to feed the parser at a time (defaults to
+        ``MMAP_CHUNK_SIZE``)
+    :param stats: A :class:`ParseStats` object to count the work done while parsing
+    :rtype: :class:`XmlElement`
+    """
+    if lazy:
+        if compact:
+            raise ValueError('Compact documents cannot be parsed lazily.')
+        if index:
+            # Building the index would parse every subtree up front.
+            raise ValueError('Lazy documents cannot be indexed.')
+        for name, used in (('intern_values', intern_values), ('use_mmap', use_mmap),
+                           ('chunk_size', chunk_size is not None), ('stats', stats is not None)):
+            if used:
+                raise ValueError('%s is not supported with lazy parsing.' % name)
+        return _parse_lazy(url_or_path, encoding, handler_class)
+    if compact:
+        if index:
+            raise ValueError('Compact documents cannot be indexed.')
+        handler = CompactHandler()
+    elif intern_values:
+        handler = handler_class(intern_values=True)
+    else:
+        handler = handler_class()
+    if stats is not None:
+        handler.stats = stats
+    parser = create_parser(handler, encoding)
     if isinstance(url_or_path, basestring):
         if '://' in url_or_path[:20]:
-            with contextlib.closing(url_lib.urlopen(url_or_path)) as f:
-                parser.ParseFile(f)
+            with contextlib.closing(open_url(url_or_path)) as f:
+                parser.ParseFile(f if stats is None else _CountingReader(f, stats))
         elif url_or_path[:100].strip().startswith('<'):
             if isinstance(url_or_path, unicode):
                 if encoding is None:
                     encoding = 'utf-8'
                 url_or_path = url_or_path.encode(encoding)
+            if stats is not None:
+                stats.bytes_fed += len(url_or_path)
             parser.Parse(url_or_path, True)
         else:
             with open(url_or_path, 'rb') as f:
-                parser.ParseFile(f)
+                if use_mmap:
+                    size = parse_mapped(parser, f, chunk_size)
+                    if stats is not None:
+                        stats.bytes_fed += size
+                else:
+                    parser.ParseFile(f if stats is None else _CountingReader(f, stats))
     elif PY3 and isinstance(url_or_path, bytes):
-        parser.ParseFile(bytes_io(url_or_path))
+        f = bytes_io(url_or_path)
+        parser.ParseFile(f if stats is None else _CountingReader(f, stats))
+    elif use_mmap and hasattr(url_or_path, 'fileno'):
+        size = parse_mapped(parser, url_or_path, chunk_size)
+        if stats is not None:
+            stats.bytes_fed += size
     else:
-        parser.ParseFile(url_or_path)
+        parser.ParseFile(url_or_path if stats is None else _CountingReader(url_or_path, stats))
+    if compact:
+        return handler.document.root
+    if index and handler.root is not None:
+        handler.root.build_index(None if index is True else index).build()
     return handler.root
 
 
+class ParseCache (object):
+    """
+    A cache of parsed documents, keyed by path or URL, with LRU eviction by number of entries and by total source size.
+    Cached paths are validated against the file's modification time and size, and cached URLs with a conditional
+    request (using the ``ETag`` and ``Last-Modified`` headers of the original response), so a document is only parsed
+    again when it has changed::
+
+        cache = drill.ParseCache(max_entries=16)
+        doc = cache.parse('/etc/app/config.xml')
+
+    By default, every hit returns the same shared tree, which must be treated as read-only. With ``copy=True``, documents
+    are cached as a :class:`CompactDocument` instead, and each hit builds a new tree from it, which is much faster than
+    parsing. Other sources (XML strings and file-like objects) are always parsed, as are URLs whose responses have
+    neither an ``ETag`` nor a ``Last-Modified`` header.
+    """
+
+    def __init__(self, max_entries=128, max_size=None, copy=False, **kwargs):
+        """
+        :param max_entries: The maximum number of documents to keep
+        :param max_size: If specified, the maximum total size (in bytes of XML) of the documents to keep
+        :param copy: If ``True``, return a new tree for every hit rather than a shared one
+        :param kwargs: Any other named arguments are passed along to :func:`parse`
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.copy = copy
+        self.kwargs = kwargs
+        # Maps each source to a (validator, size, document) tuple, least recently used first.
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def parse(self, url_or_path):
+        """
+        Returns the parsed document for a path or URL, from the cache if it is still valid.
+
+        :param url_or_path: A filesystem path or URL (anything else is passed straight to :func:`parse`)
+        :rtype: :class:`XmlElement`
+        """
+        if not isinstance(url_or_path, basestring) or url_or_path[:100].strip().startswith('<'):
+            return parse(url_or_path, **self.kwargs)
+        with self.lock:
+            entry = self.entries.get(url_or_path)
+        if '://' in url_or_path[:20]:
+            result = self._load_url(url_or_path, entry)
+        else:
+            result = self._load_path(url_or_path, entry)
+        if result is None:
+            with self.lock:
+                self.hits += 1
+                if url_or_path in self.entries:
+                    self.entries[url_or_path] = self.entries.pop(url_or_path)
+            doc = entry[2]
+            if self.copy:
+                handler_class = self.kwargs.get('handler_class', DrillHandler)
+                return doc.to_element(getattr(handler_class, 'element_class', XmlElement))
+            return doc
+        validator, size, doc = result
+        stored = None
+        if validator is not None and (self.max_size is None or size <= self.max_size):
+            stored = CompactDocument.from_element(doc) if self.copy else doc
+        with self.lock:
+            self.misses += 1
+            old = self.entries.pop(url_or_path, None)
+            if old is not None:
+                self.size -= old[1]
+            if stored is not None:
+                self.entries[url_or_path] = (validator, size, stored)
+                self.size += size
+                while len(self.entries) > self.max_entries or (self.max_size is not None and self.size > self.max_size):
+                    self.size -= self.entries.popitem(last=False)[1][1]
+        return doc
+
+    def clear(self):
+        """
+        Removes every document from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _load_path(self, path, entry):
+        """
+        Returns ``None`` if the cached entry for a path is still valid, otherwise parses it and returns a tuple of
+        ``(validator, size, document)``.
+        """
+        st = os.stat(path)
+        validator = (st.st_mtime, st.st_size)
+        if entry is not None and entry[0] == validator:
+            return None
+        return validator, st.st_size, parse(path, **self.kwargs)
+
+    def _load_url(self, url, entry):
+        """
+        Returns ``None`` if the server says the cached entry for a URL is still valid, otherwise parses the response
+        and returns a tuple of ``(validator, size, document)``.
+        """
+        headers = {}
+        if entry is not None:
+            etag, modified = entry[0]
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+        try:
+            response = open_url(url, headers)
+        except url_lib.HTTPError as e:
+            e.close()
+            if e.code == 304 and entry is not None:
+                return None
+            raise
+        with contextlib.closing(response):
+            headers = response.info()
+            validator = (headers.get('ETag'), headers.get('Last-Modified'))
+            counter = ParseStats()
+            doc = parse(_CountingReader(response, counter), **self.kwargs)
+        return (validator if any(validator) else None), counter.bytes_fed, doc
+
+
+def load_snapshot(path, compact=False, element_class=XmlElement):
+    """
+    Loads a document saved with :meth:`XmlElement.save_snapshot`.
+
+    :param path: The filesystem path of the snapshot
+    :param compact: If ``True``, return a read-only :class:`CompactElement` whose document is backed directly by a
+        memory map of the snapshot, so loading is nearly instant and processes loading the same snapshot share its
+        memory. Otherwise, build a regular tree of ``element_class`` elements.
+    :param element_class: The class of elements to build, if not ``compact``
+    :rtype: :class:`XmlElement`
+    """
+    doc = CompactDocument.load(path)
+    if compact:
+        return doc.root
+    return doc.to_element(element_class)
+
+
 class DrillElementIterator (object):
     READ_CHUNK_SIZE = 16384
-
-    def __init__(self, filelike, parser):
+    # When max_pending is set, chunks are fed to the parser in slices of this size, so feeding can pause part way
+    # through a chunk once enough elements are pending.
+    FEED_SLICE_SIZE = 1024
+    # With adaptive chunk sizing, the chunk size is doubled when a chunk produces fewer than ADAPT_LOW elements, and
+    # halved when it produces more than ADAPT_HIGH (which would otherwise all be held in memory at once), staying
+    # between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE.
+    MIN_CHUNK_SIZE = 4096
+    MAX_CHUNK_SIZE = 4194304
+    ADAPT_LOW = 8
+    ADAPT_HIGH = 256
+
+    def __init__(self, filelike, parser, max_pending=None, release=False, chunk_size=None, owned=False,
+                 adaptive=False):
         self.filelike = filelike
         self.parser = parser
-        self.elements = []
+        self.chunk_size = chunk_size or self.READ_CHUNK_SIZE
+        self.adaptive = adaptive
+        # Sources supporting readinto are read into a reusable buffer, rather than allocating bytes for every chunk.
+        self._buffer = bytearray() if PY3 and hasattr(filelike, 'readinto') else None
+        # Whether filelike was opened by drill, and should be closed once parsing is finished.
+        self.owned = owned
+        self.elements = collections.deque()
+        self.max_pending = max_pending
+        self.finished = False
+        # If release is set, consumed elements are detached from the tree before more input is parsed.
+        self.release = release
+        self._released = []
+        # The handler building the tree, used to tell which open elements may still be yielded.
+        self.handler = None
+        # Data that has been read, but not yet fed to the parser (only used when max_pending is set).
+        self._data = b''
+        self._offset = 0
+        self._produced = 0
+        # A ParseStats object, if counting is enabled.
+        self.stats = None
 
     def add(self, element):
         self.elements.append(element)
@@ -592,26 +2733,458 @@ class DrillElementIterator (object):
 
     def next(self):
         while not self.elements:
-            data = self.filelike.read(self.READ_CHUNK_SIZE)
+            if self._released:
+                self.detach(self._released)
+                self._released = []
+            if self.finished:
+                raise StopIteration
+            self.feed()
+        item = self.elements.popleft()
+        if self.release:
+            # With multiple xpaths, items are (name, element) pairs.
+            self._released.append(item[1] if isinstance(item, tuple) else item)
+        return item
+
+    def detach(self, elements):
+        """
+        Detaches consumed elements from their parents, and trims the child lists of their ancestors. This is only done
+        once every pending element has been consumed, so the tree (and sibling indexes) don't change while a chunk's
+        elements are being iterated. Elements are completed in document order, so any siblings before a consumed
+        element (or before one of its ancestors) are finished, and have already been yielded or were never going to
+        be. Elements inside one that is still being parsed and may be yielded later are left alone, so it is complete,
+        and they are released along with it.
+        """
+        handler = self.handler
+        # The open elements that may still be yielded: those where the handler's stack recorded a match.
+        pending = set()
+        built = [entry for entry in handler.stack if entry[1]]
+        elem = handler.current
+        for entry in reversed(built):
+            if elem is None:
+                break
+            if entry[3]:
+                pending.add(id(elem))
+            elem = elem.parent
+        consumed = set(id(e) for e in elements)
+        last = None
+        for element in elements:
+            ancestor = element.parent
+            while ancestor is not None and id(ancestor) not in pending and id(ancestor) not in consumed:
+                ancestor = ancestor.parent
+            if ancestor is None:
+                if last is not None and last is not element:
+                    last.parent = None
+                last = element
+        if last is None:
+            return
+        # Trimming up to the last consumed element also trims every one before it.
+        child = last
+        parent = last.parent
+        last.parent = None
+        while parent is not None:
+            children = parent._children
+            if children and children[0] is child:
+                pos = 0
+            else:
+                try:
+                    pos = children.index(child)
+                except ValueError:
+                    # Already trimmed by a previous release.
+                    break
+            del children[:pos + 1 if child is last else pos]
+            for idx, c in enumerate(children):
+                c.index = idx
+            child = parent
+            parent = parent.parent
+
+    def feed(self):
+        """
+        Reads data from the underlying file-like object and feeds it to the parser. If ``max_pending`` is set, data is
+        fed in slices, stopping once that many elements are pending.
+        """
+        if self.max_pending is None:
+            pending = len(self.elements)
+            data = self.read()
             self.parser.Parse(data, not data)
+            if self.stats is not None:
+                self.stats.queued(len(self.elements))
             if not data:
-                raise StopIteration
-        return self.elements.pop(0)
+                self.finish()
+            elif self.adaptive:
+                self.adapt(len(self.elements) - pending)
+            return
+        while len(self.elements) < self.max_pending:
+            if self._offset >= len(self._data):
+                if self.adaptive and self._data:
+                    self.adapt(self._produced)
+                self._data = self.read()
+                self._offset = 0
+                self._produced = 0
+                if not self._data:
+                    self.parser.Parse(self._data, True)
+                    self.finish()
+                    return
+            pending = len(self.elements)
+            end = self._offset + min(self.FEED_SLICE_SIZE, self.chunk_size)
+            self.parser.Parse(self._data[self._offset:end], False)
+            self._offset = end
+            self._produced += len(self.elements) - pending
+            if self.stats is not None:
+                self.stats.queued(len(self.elements))
+
+    def read(self):
+        """
+        Reads the next chunk of at most ``chunk_size`` bytes from the underlying file-like object.
+        """
+        if self._buffer is None:
+            data = self.filelike.read(self.chunk_size)
+        else:
+            if len(self._buffer) != self.chunk_size:
+                # Slices of the old buffer may still be around, so allocate a new one rather than resizing it.
+                self._buffer = bytearray(self.chunk_size)
+            size = self.filelike.readinto(self._buffer)
+            data = memoryview(self._buffer)[:size or 0]
+        if self.stats is not None:
+            self.stats.bytes_fed += len(data)
+        return data
+
+    def adapt(self, produced):
+        """
+        Adjusts the chunk size, based on the number of elements produced by the last chunk.
+        """
+        if produced < self.ADAPT_LOW:
+            self.chunk_size = min(self.chunk_size * 2, self.MAX_CHUNK_SIZE)
+        elif produced > self.ADAPT_HIGH:
+            self.chunk_size = max(self.chunk_size // 2, self.MIN_CHUNK_SIZE)
+
+    def finish(self):
+        self.finished = True
+        self._data = b''
+        if self.owned:
+            self.filelike.close()
 
     def __iter__(self):
         return self
 
 
-def iterparse(filelike, encoding=None, handler_class=DrillHandler, xpath=None):
+def iterparse(filelike, encoding=None, handler_class=DrillHandler, xpath=None, max_pending=None, release=False,
+              intern_values=False, use_mmap=False, chunk_size=None, adaptive=False, stats=None):
     """
-    :param filelike: A file-like object with a ``read`` method
+    :param filelike: A file-like object with a ``read`` method, a filesystem path, or a URL
+    :param xpath: If specified, only yield elements matching this path from the document root, such as
+        ``root/*/record`` or ``//record[@type="x"]``. Elements that can't contain a match are skipped without being
+        built, and elements passed over by a ``//`` are not built either, so matches are attached to their nearest
+        built ancestor. May also be a mapping of names to paths, in which case ``(name, element)`` pairs are yielded
+        for every path an element matches, all from a single pass over the document.
+    :param max_pending: If specified, stop feeding the parser once this many parsed elements are waiting to be
+        yielded, so a single chunk producing a burst of elements doesn't hold them all in memory at once
+    :param release: If ``True``, yielded elements are detached from their parents (and finished elements are trimmed
+        from their ancestors) once every pending element has been consumed, before more of the document is parsed, so
+        memory use is bounded by the depth of the document and the size of a chunk rather than the size of the document.
+        Matches nested inside a later match are released along with it. Keep a reference to any element you need after
+        moving on. Requires an ``xpath``, since otherwise every open element is still to be yielded.
+    :param intern_values: If ``True``, share a single string between all equal attribute values
+    :param use_mmap: If ``True``, memory-map the file (which must be a path or have a ``fileno``) and feed the parser
+        slices of the mapping, rather than reading chunks into new buffers
+    :param chunk_size: The number of bytes to feed the parser at a time (defaults to
+        ``DrillElementIterator.READ_CHUNK_SIZE``, or ``MMAP_CHUNK_SIZE`` with ``use_mmap``)
+    :param adaptive: If ``True``, grow the chunk size when chunks produce few elements, and shrink it when they produce
+        many pending elements at once
+    :param stats: A :class:`ParseStats` object to count the work done while parsing
     :returns: An iterator yielding :class:`XmlElement` objects
     """
-    parser = expat.ParserCreate(encoding)
-    elem_iter = DrillElementIterator(filelike, parser)
-    handler = handler_class(elem_iter, xpath)
-    parser.buffer_text = 1
-    parser.StartElementHandler = handler.start_element
-    parser.EndElementHandler = handler.end_element
-    parser.CharacterDataHandler = handler.characters
+    if release and xpath is None:
+        raise ValueError('release requires an xpath, since without one every open element is still to be yielded.')
+    owned = False
+    if isinstance(filelike, basestring):
+        if '://' in filelike[:20]:
+            if use_mmap:
+                raise ValueError('URLs cannot be memory-mapped.')
+            filelike = open_url(filelike)
+        else:
+            filelike = open(filelike, 'rb')
+        owned = True
+    if use_mmap:
+        mapped = MappedFile(filelike)
+        if owned:
+            # The mapping stays valid after the file is closed.
+            filelike.close()
+        filelike = mapped
+        owned = True
+        chunk_size = chunk_size or MMAP_CHUNK_SIZE
+    elem_iter = DrillElementIterator(filelike, None, max_pending=max_pending, release=release, chunk_size=chunk_size,
+                                     owned=owned, adaptive=adaptive)
+    if intern_values:
+        handler = handler_class(elem_iter, xpath, intern_values=True)
+    else:
+        handler = handler_class(elem_iter, xpath)
+    if stats is not None:
+        handler.stats = elem_iter.stats = stats
+    elem_iter.handler = handler
+    elem_iter.parser = create_parser(handler, encoding)
     return elem_iter
+
+
+class DrillParser (object):
+    """
+    A push-style parser, for data that arrives in pieces from a socket, a selector loop, or a decompressor callback.
+    Chunks are parsed as they are passed to :meth:`feed`, and elements are queued (or passed to ``callback``) as soon as
+    they are complete::
+
+        parser = drill.DrillParser(xpath='export/record')
+        for chunk in chunks:
+            parser.feed(chunk)
+            for record in parser.pop_elements():
+                ...
+        root = parser.close()
+    """
+
+    def __init__(self, xpath=None, encoding=None, handler_class=DrillHandler, callback=None, intern_values=False,
+                 stats=None):
+        """
+        :param xpath: If specified, only queue elements matching this path, see :func:`iterparse`
+        :param encoding: The encoding of the fed data, if it isn't declared in the document
+        :param handler_class: The handler class used to build elements
+        :param callback: If specified, a function called with each completed element from within :meth:`feed`, instead
+            of queueing it
+        :param intern_values: If ``True``, share a single string between all equal attribute values
+        :param stats: A :class:`ParseStats` object to count the work done while parsing
+        """
+        self.elements = collections.deque()
+        self.callback = callback
+        if intern_values:
+            self.handler = handler_class(self, xpath, intern_values=True)
+        else:
+            self.handler = handler_class(self, xpath)
+        self.stats = stats
+        if stats is not None:
+            self.handler.stats = stats
+        self.parser = create_parser(self.handler, encoding)
+        self.closed = False
+
+    def add(self, element):
+        if self.callback is None:
+            self.elements.append(element)
+        else:
+            self.callback(element)
+
+    def feed(self, data):
+        """
+        Parses a chunk of data.
+        """
+        self.parser.Parse(data, False)
+        if self.stats is not None:
+            self.stats.bytes_fed += len(data)
+            self.stats.queued(len(self.elements))
+
+    def close(self):
+        """
+        Signals the end of the data, and returns the root element.
+
+        :rtype: :class:`XmlElement`
+        """
+        try:
+            self.parser.Parse(b'', True)
+        finally:
+            self.closed = True
+        return self.handler.root
+
+    def pop_elements(self):
+        """
+        Returns a list of the elements completed since the last call, and removes them from the queue.
+        """
+        elements = list(self.elements)
+        self.elements.clear()
+        return elements
+
+
+class AsyncIterParser (DrillParser):
+    """
+    A :class:`DrillParser` for asyncio. Data is pushed in with :meth:`feed` as it arrives (from an HTTP response, or a
+    message queue), and the matching elements can be consumed with ``async for`` from another task::
+
+        parser = drill.AsyncIterParser(xpath='export/record')
+        # In the producer:
+        parser.feed(chunk)
+        parser.close()
+        # In the consumer:
+        async for record in parser:
+            ...
+
+    Each call to ``feed`` only runs expat over the new data, so the event loop is never blocked for longer than it
+    takes to parse one chunk.
+    """
+
+    def __init__(self, xpath=None, encoding=None, handler_class=DrillHandler, intern_values=False, stats=None):
+        """
+        :param xpath: If specified, only yield elements matching this path, see :func:`iterparse`
+        :param encoding: The encoding of the fed data, if it isn't declared in the document
+        :param handler_class: The handler class used to build elements
+        :param intern_values: If ``True``, share a single string between all equal attribute values
+        :param stats: A :class:`ParseStats` object to count the work done while parsing
+        """
+        super(AsyncIterParser, self).__init__(xpath, encoding, handler_class, intern_values=intern_values, stats=stats)
+        self.error = None
+        self._waiter = None
+
+    def feed(self, data):
+        """
+        Parses a chunk of data, waking up a consumer waiting for the next element if any were completed.
+        """
+        try:
+            super(AsyncIterParser, self).feed(data)
+        except expat.ExpatError as e:
+            self.error = e
+            raise
+        finally:
+            self._wake()
+
+    def close(self):
+        """
+        Signals the end of the data, and returns the root element. Any consumer still waiting will receive the
+        remaining elements, and then stop.
+        """
+        try:
+            return super(AsyncIterParser, self).close()
+        except expat.ExpatError as e:
+            self.error = e
+            raise
+        finally:
+            self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            if self.elements or self.error is not None or self.closed:
+                waiter, self._waiter = self._waiter, None
+                self._resolve(waiter)
+
+    def _resolve(self, future):
+        if self.elements:
+            future.set_result(self.elements.popleft())
+        elif self.error is not None:
+            future.set_exception(self.error)
+        else:
+            future.set_exception(StopAsyncIteration())
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        """
+        Returns a future for the next element, which is resolved once it has been parsed.
+        """
+        import asyncio
+        future = asyncio.get_event_loop().create_future()
+        if self.elements or self.error is not None or self.closed:
+            self._resolve(future)
+        else:
+            self._waiter = future
+        return future
+
+
+def _record_tag(xpath):
+    """
+    Guesses the tag of the top-level records an xpath selects from, such as ``record`` for ``root/record/field`` or
+    ``//record``.
+    """
+    steps = compile(xpath).steps
+    tag = steps[0].tag if len(steps) == 1 else steps[1].tag
+    if tag == '*':
+        raise ValueError('Could not determine the record tag from %r, please specify it.' % xpath)
+    return tag
+
+
+def split_records(data, record, parts):
+    """
+    Splits an XML document into about ``parts`` ranges of top-level ``record`` elements. The document must use an
+    ASCII-compatible encoding, and records must not be nested, or appear in comments or CDATA sections.
+
+    :param data: The document, as bytes or an mmap
+    :returns: A tuple of ``(prefix, ranges, suffix)``, where ``prefix`` is everything up to and including the root start
+        tag, ``suffix`` is the root end tag, and ``ranges`` is a list of ``(start, end)`` byte offsets, such that
+        ``prefix + data[start:end] + suffix`` is a well-formed document
+    """
+    root = start_tag_re.match(data, prolog_re.match(data).end())
+    if root is None:
+        raise ValueError('No root element found.')
+    start = root.end()
+    tagname = data[root.start() + 1:start].split(None, 1)[0].rstrip(b'/>')
+    prefix = data[:start]
+    if data[start - 2:start] == b'/>':
+        return prefix, [], b''
+    end = data.rfind(b'</' + tagname)
+    if end < start:
+        raise ValueError('No closing tag found for the root element.')
+    boundary_re = re.compile(b'<' + re.escape(record.encode('utf-8')) + br'[\s/>]')
+    offsets = [start]
+    step = max((end - start) // max(parts, 1), 1)
+    for target in range(start + step, end, step):
+        match = boundary_re.search(data, max(target, offsets[-1] + 1), end)
+        if match is None:
+            break
+        if match.start() > offsets[-1]:
+            offsets.append(match.start())
+    offsets.append(end)
+    return prefix, list(zip(offsets, offsets[1:])), b'</' + tagname + b'>'
+
+
+def _parse_range(args):
+    """
+    Parses one range of a document in a worker process, for :func:`parallel_iterparse`.
+    """
+    path, prefix, start, end, suffix, xpath, encoding, func = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    results = []
+    for elem in iterparse(bytes_io(prefix + data + suffix), encoding=encoding, xpath=xpath, release=True):
+        results.append(elem if func is None else func(elem))
+    if func is None:
+        # Don't send the (partial) ancestors back with every element. This is only done once the iterator has released
+        # them, since release needs the parent to trim finished records from the tree.
+        for elem in results:
+            elem.parent = None
+    return results
+
+
+def parallel_iterparse(path, xpath, workers=None, func=None, ordered=True, record=None, encoding=None, chunks=None):
+    """
+    Parses a document made up of many independent top-level records using a pool of processes. The file is split at
+    record start tags into ranges, and each range is parsed (with the document's prolog and root element around it)
+    by :func:`iterparse` in a worker process.
+
+    The document must use an ASCII-compatible encoding (such as UTF-8), records must not be nested inside each other,
+    and record start tags must not appear in comments or CDATA sections.
+
+    :param path: A filesystem path
+    :param xpath: The elements to yield, see :func:`iterparse`
+    :param workers: The number of worker processes (defaults to the number of CPUs)
+    :param func: If specified, a function called on each element in the worker process, whose result is yielded
+        instead of the element. It must be picklable, i.e. defined at the top level of a module.
+    :param ordered: If ``True``, results are yielded in document order, otherwise ranges are yielded as they complete
+    :param record: The tag of the top-level records to split the document at (defaults to the tag of the second step of
+        ``xpath``, or the only step of a ``//record`` query)
+    :param chunks: The number of ranges to split the document into (defaults to four per worker)
+    :returns: An iterator yielding :class:`XmlElement` objects (detached from their parents), or the results of
+        ``func``
+    """
+    import multiprocessing
+    workers = workers or multiprocessing.cpu_count()
+    with open(path, 'rb') as f:
+        data = map_file(f)
+        try:
+            prefix, ranges, suffix = split_records(data, record or _record_tag(xpath), chunks or workers * 4)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    tasks = [(path, prefix, start, end, suffix, xpath, encoding, func) for start, end in ranges]
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.imap(_parse_range, tasks) if ordered else pool.imap_unordered(_parse_range, tasks)
+        for chunk in results:
+            for item in chunk:
+                yield item
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
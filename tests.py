@@ -3,7 +3,11 @@
 
 import drill
 
+import io
+import json
+import mmap
 import os
+import tempfile
 import unittest
 
 
@@ -24,6 +28,10 @@ class CustomHandler (drill.DrillHandler):
     element_class = CustomElement
 
 
+def record_id(elem):
+    return elem.attrs.get('id')
+
+
 class DrillTests (unittest.TestCase):
 
     def setUp(self):
@@ -53,7 +61,7 @@ class DrillTests (unittest.TestCase):
         self.assertEqual(self.catalog.last('book')['id'], 'book2')
         # Recursive find.
         titles = [unicode(t) for t in self.catalog.iter('title')]
-        self.assertEqual(titles, ['Test Book', u('Él Libro'), 'Test Magazine'])
+        self.assertEqual(titles, ['Test Book', u('Él Libro'), 'Test Magazine', 'Nonsense'])
         # Next sibling matching tag name.
         self.assertEqual(self.catalog.book.author.next('title')['language'], 'en')
         # Previous sibling.
@@ -65,6 +73,22 @@ class DrillTests (unittest.TestCase):
         self.assertEqual([p.tagname for p in gc.siblings()], ['author', 'title'])
         self.assertEqual(len(list(gc.siblings('title'))), 1)
 
+    def test_iter(self):
+        # With no arguments, every descendant is yielded in document order.
+        tags = [e.tagname for e in self.catalog.iter()]
+        self.assertEqual(tags, [
+            'book', 'author', 'isbn', 'title',
+            'book', 'author', 'isbn', 'title', 'extra_element',
+            'magazine', 'author', 'title', 'price', 'book', 'title', 'isbn',
+        ])
+        # Descendants at any depth are found.
+        self.assertEqual([e.path() for e in self.catalog.iter('isbn')], ['book[0]/isbn[1]', 'book[1]/isbn[1]', 'magazine[2]/book[3]/isbn[1]'])
+        # Multiple tag names, attribute presence, and depth limits.
+        self.assertEqual([e.tagname for e in self.catalog.iter(['book', 'magazine'], max_depth=1)], ['book', 'book', 'magazine'])
+        self.assertEqual([e.tagname for e in self.catalog.iter(attrs='marked')], ['isbn', 'price'])
+        self.assertEqual([e['id'] for e in self.catalog.iter(attrs=['id', 'author'])], ['book1', 'book2', 'mag1'])
+        self.assertEqual(len(list(self.catalog.iter('title', max_depth=2))), 3)
+
     def test_query(self):
         # Find all book ISBNs.
         isbns = [unicode(e) for e in self.catalog.find('book/isbn')]
@@ -95,6 +119,544 @@ class DrillTests (unittest.TestCase):
         # Underscores in tag names.
         self.assertEqual([e.path() for e in self.catalog.find('book/extra_element')], ['book[1]/extra_element[3]'])
 
+    def test_compiled_query(self):
+        q = drill.compile('//book[@id="book2"]/isbn')
+        # Compiled queries are cached by query string.
+        self.assertIs(drill.compile('//book[@id="book2"]/isbn'), q)
+        self.assertIs(drill.compile(q), q)
+        self.assertEqual([s.tag for s in q.steps], ['book', 'isbn'])
+        self.assertEqual([s.deep for s in q.steps], [True, False])
+        self.assertEqual([unicode(e) for e in self.catalog.find(q)], ['0-684-84328-6'])
+        self.assertEqual(self.catalog.find(q).query, '//book[@id="book2"]/isbn')
+        # Each // applies to the step that follows it.
+        self.assertEqual([unicode(e) for e in self.catalog.find('//magazine//title')], ['Test Magazine', 'Nonsense'])
+        self.assertRaises(ValueError, drill.compile, '')
+        self.assertRaises(ValueError, drill.compile, 'book/#')
+
+    def test_deep_query(self):
+        # Queries should not be limited by the recursion limit on deeply nested documents.
+        root = drill.XmlElement('root')
+        e = root
+        for i in range(5000):
+            e = e.append('level', attrs={'n': str(i)})
+        self.assertEqual(len(list(root.find('//level'))), 5000)
+        self.assertEqual([x['n'] for x in root.find('//level/level[@n=4999]')], ['4999'])
+
+    def test_multiple_deep_steps(self):
+        # Nodes reachable through several ancestors matching a deep step are only found once, in document order.
+        doc = drill.parse(b'<r><a id="1"><a id="2"><a id="3"><b id="x"/></a><b id="y"/></a></a><b id="z"/></r>')
+        self.assertEqual([e['id'] for e in doc.find('//a//b')], ['x', 'y'])
+        self.assertEqual([e['id'] for e in doc.find('//*//b')], ['x', 'y'])
+        self.assertEqual([e['id'] for e in doc.find('//a//a')], ['2', '3'])
+        self.assertEqual([e['id'] for e in doc.find('//a/a//b')], ['x', 'y'])
+        self.assertEqual([e['id'] for e in doc.find('//b')], ['x', 'y', 'z'])
+
+    def test_index(self):
+        doc = drill.parse(self.path, index=[('book', 'id'), ('title', 'language')])
+        self.assertIsNotNone(doc._index)
+        self.assertEqual([e.path() for e in doc.find('//book')], [e.path() for e in self.catalog.find('//book')])
+        self.assertEqual([e.path() for e in doc.find('//book[@id="book2"]')], ['book[1]'])
+        self.assertEqual([unicode(e) for e in doc.find('//title[@language=en]')], ['Test Book', 'Test Magazine'])
+        # Non-indexed predicates are filtered from the tag index.
+        self.assertEqual([e.path() for e in doc.find('//book[isbn]')], ['book[0]', 'book[1]', 'magazine[2]/book[3]'])
+        self.assertEqual([unicode(e) for e in doc.iter('title')], ['Test Book', u('Él Libro'), 'Test Magazine', 'Nonsense'])
+        # The index should stay consistent as the tree changes.
+        doc.magazine.book.append('title', attrs={'language': 'en'}, data='Appended')
+        doc.insert(0, 'book', attrs={'id': 'book0'})
+        self.assertEqual([e['id'] for e in doc.find('//book[@id="book0"]')], ['book0'])
+        self.assertEqual([unicode(e) for e in doc.find('//title[@language="en"]')], ['Test Book', 'Test Magazine', 'Appended'])
+        doc.magazine.clear()
+        self.assertEqual(len(list(doc.iter('title'))), 2)
+        self.assertEqual(list(doc.find('//book[@id="mag1"]')), [])
+        # An index can also be created after parsing, and is built on first use.
+        index = self.catalog.build_index([('isbn', 'marked')])
+        self.assertEqual([unicode(e) for e in self.catalog.find('//isbn[@marked=1]')], ['0-684-84328-6'])
+        self.assertEqual(index.lookup('isbn', 'marked', '1'), [self.catalog[1].isbn])
+        # Changes inside a subtree with its own index also invalidate the enclosing document index.
+        doc = drill.parse(drill.bytes_io(b'<r><s><a/></s></r>'), index=True)
+        sub = doc.s.build_index()
+        sub.build()
+        doc.s.append('a')
+        doc.s.insert(0, 'a')
+        self.assertEqual(len(list(doc.find('//a'))), 3)
+        self.assertEqual(len(list(doc.s.find('//a'))), 3)
+        # Rebuilding the document index leaves the subtree index in place.
+        doc.s.a.append('a')
+        self.assertEqual(len(list(doc.find('//a'))), 4)
+        self.assertIs(doc.s.a._index, sub)
+        self.assertEqual(len(list(doc.s.find('//a'))), 4)
+        doc.s.clear()
+        self.assertEqual(list(doc.find('//a')), [])
+
+    def test_compact(self):
+        doc = drill.parse(self.path, compact=True)
+        self.assertIsInstance(doc, drill.CompactElement)
+        self.assertEqual(len(doc.document), 17)
+        self.assertEqual(unicode(doc.book.author), 'Watson, Dan')
+        self.assertEqual(doc[1]['author'], u('josé'))
+        self.assertEqual(doc.book.title.attrs, {'language': 'en'})
+        self.assertEqual(doc.book.author.next('title')['language'], 'en')
+        self.assertEqual([p.tagname for p in doc.first('book').first('isbn').parents()], ['book', 'catalog'])
+        self.assertEqual(doc.magazine.book.parent, doc.magazine)
+        # Queries, iteration, and serialization behave the same as the regular tree.
+        for q in ('//book/isbn', '*/author', '*[author="Watson, Dan"]', '*/*[@marked=1]', '*[-2]/*[-1]', 'magazine//title'):
+            self.assertEqual([e.path() for e in doc.find(q)], [e.path() for e in self.catalog.find(q)])
+        self.assertEqual([e.path() for e in doc.iter('title')], [e.path() for e in self.catalog.iter('title')])
+        self.assertEqual(doc.xml(), self.catalog.xml())
+        self.assertEqual(doc.json(attributes=True), self.catalog.json(attributes=True))
+        # Child counts, indexing, and sibling navigation walk the node arrays, and agree with the regular tree.
+        for compact, elem in zip([doc] + list(doc.iter()), [self.catalog] + list(self.catalog.iter())):
+            self.assertEqual(len(compact), len(elem))
+            for i in range(-len(elem), len(elem)):
+                self.assertEqual(compact[i].path(), elem[i].path())
+            self.assertRaises(IndexError, compact.__getitem__, len(elem))
+            self.assertRaises(IndexError, compact.__getitem__, -len(elem) - 1)
+            for name in (None, 'book', 'title'):
+                for method in ('next', 'prev', 'first', 'last'):
+                    found, expected = getattr(compact, method)(name), getattr(elem, method)(name)
+                    self.assertEqual(found and found.path(), expected and expected.path())
+            self.assertEqual([c.path() for c in compact.children(reverse=True)], [c.path() for c in elem.children(reverse=True)])
+        self.assertEqual([e.path() for e in doc[1:]], [e.path() for e in self.catalog[1:]])
+        # Compact documents are read-only.
+        self.assertRaises(TypeError, doc.append, 'book')
+        self.assertRaises(TypeError, doc.book.clear)
+        self.assertRaises(AttributeError, setattr, doc.book, 'data', 'x')
+
+    def test_interning(self):
+        doc = drill.parse(self.path, intern_values=True)
+        en = [e for e in doc.iter('title') if e.attrs.get('language') == 'en']
+        self.assertIs(en[0].attrs['language'], en[1].attrs['language'])
+        self.assertIs(doc[0].tagname, doc[1].tagname)
+        # Elements without attributes share storage, but still get their own dict to modify.
+        author, isbn = doc.book.author, doc.book.isbn
+        self.assertIs(author._attrs, isbn._attrs)
+        author.attrs['x'] = '1'
+        self.assertEqual(author.attrs, {'x': '1'})
+        self.assertEqual(isbn.attrs, {})
+        self.assertEqual(doc.book.author.xml(pretty=False), b'<author x="1">Watson, Dan</author>')
+        doc.book.clear()
+        self.assertEqual(doc.book.attrs, {})
+
+    def test_lazy(self):
+        doc = drill.parse(self.path, lazy=True)
+        self.assertEqual([e.loaded for e in doc], [False, False, False])
+        # Attributes are available without parsing the subtree.
+        self.assertEqual(doc[1]['author'], u('josé'))
+        self.assertFalse(doc[1].loaded)
+        # Touching the children or data parses the subtree.
+        self.assertEqual(unicode(doc[1].author), u('Rodriguez, José'))
+        self.assertTrue(doc[1].loaded)
+        self.assertEqual(doc[1].author.parent, doc[1])
+        self.assertEqual([unicode(e) for e in doc.find('magazine//title')], ['Test Magazine', 'Nonsense'])
+        self.assertEqual([e.loaded for e in doc], [False, True, True])
+        self.assertEqual(doc.xml(), self.catalog.xml())
+        # Empty elements (with tricky attributes) and custom element classes.
+        doc = drill.parse(b'<r><a x="/>"/><b/><c></c><r><r/></r></r>', lazy=True, handler_class=CustomHandler)
+        self.assertTrue(all(isinstance(e, CustomElement) for e in doc))
+        self.assertEqual(doc.xml(pretty=False), b'<r><a x="/&gt;"></a><b></b><c></c><r><r></r></r></r>')
+        self.assertEqual(doc[3][0].__class__, CustomElement)
+        # Options that would parse everything up front, or would be ignored, are rejected.
+        for kwargs in ({'index': True}, {'compact': True}, {'intern_values': True}, {'use_mmap': True},
+                       {'chunk_size': 64}, {'stats': drill.ParseStats()}):
+            self.assertRaises(ValueError, drill.parse, self.path, lazy=True, **kwargs)
+
+    def test_mmap(self):
+        doc = drill.parse(self.path, use_mmap=True, chunk_size=64)
+        self.assertEqual(doc.xml(), self.catalog.xml())
+        with open(self.path, 'rb') as f:
+            self.assertEqual(drill.parse(f, use_mmap=True).xml(), self.catalog.xml())
+        # Paths are opened (and closed) by iterparse.
+        titles = [unicode(e) for e in drill.iterparse(self.path, xpath='catalog/book/title', use_mmap=True, chunk_size=100)]
+        self.assertEqual(titles, ['Test Book', u('Él Libro')])
+        elem_iter = drill.iterparse(self.path, chunk_size=100)
+        self.assertEqual(len(list(elem_iter)), len(list(self.catalog.iter())) + 1)
+        self.assertTrue(elem_iter.filelike.closed)
+
+    def test_iterparse_chunk_size(self):
+        with open(self.path, 'rb') as f:
+            xml = f.read()
+        expected = [e.tagname for e in drill.iterparse(io.BytesIO(xml))]
+        # Few elements per chunk grows the chunk size.
+        elem_iter = drill.iterparse(io.BytesIO(xml), chunk_size=64, adaptive=True)
+        self.assertIsNotNone(elem_iter._buffer)
+        self.assertEqual([e.tagname for e in elem_iter], expected)
+        self.assertGreater(elem_iter.chunk_size, 64)
+        # Many elements per chunk shrinks it, within the limits.
+        many = b'<r>' + b'<a/>' * 5000 + b'</r>'
+        elem_iter = drill.iterparse(io.BytesIO(many), chunk_size=16384, adaptive=True)
+        self.assertEqual(len(list(elem_iter)), 5001)
+        self.assertEqual(elem_iter.chunk_size, drill.DrillElementIterator.MIN_CHUNK_SIZE)
+        elem_iter = drill.iterparse(io.BytesIO(xml), chunk_size=10, max_pending=2, adaptive=True)
+        self.assertEqual([e.tagname for e in elem_iter], expected)
+        self.assertGreater(elem_iter.chunk_size, 10)
+
+    def test_parallel_iterparse(self):
+        records = b''.join(b'<record id="%d"><value>%d</value></record>\n' % (i, i) for i in range(100))
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'<?xml version="1.0"?>\n<!-- <fake> -->\n<export version="1">\n' + records + b'<record/></export>\n')
+        try:
+            expected = [e.attrs.get('id') for e in drill.iterparse(path, xpath='export/record')]
+            results = drill.parallel_iterparse(path, 'export/record', workers=2, chunks=7)
+            self.assertEqual([e.attrs.get('id') for e in results], expected)
+            self.assertEqual(list(drill.parallel_iterparse(path, 'export/record', workers=2, func=record_id)), expected)
+            values = drill.parallel_iterparse(path, '//value', workers=2, ordered=False, record='record')
+            self.assertEqual(sorted(int(e.data) for e in values), list(range(100)))
+            self.assertRaises(ValueError, lambda: list(drill.parallel_iterparse(path, 'export/*', workers=2)))
+            # Workers release records as they go, rather than keeping their whole range attached to the root.
+            with open(path, 'wb') as f:
+                f.write(b'<export>' + b''.join(b'<record id="%d"><value/></record>' % i for i in range(1000)) + b'</export>')
+            with open(path, 'rb') as f:
+                prefix, ranges, suffix = drill.split_records(f.read(), 'record', 1)
+            roots = []
+
+            def retained(elem):
+                roots.append(elem.parent)
+                return len(elem.parent)
+            sizes = drill._parse_range((path, prefix, ranges[0][0], ranges[0][1], suffix, 'export/record', None, retained))
+            self.assertEqual(len(sizes), 1000)
+            self.assertLess(max(sizes), 1000)
+            self.assertEqual(len(roots[-1]), 0)
+            results = drill._parse_range((path, prefix, ranges[0][0], ranges[0][1], suffix, 'export/record', None, None))
+            self.assertTrue(all(e.parent is None for e in results))
+        finally:
+            os.remove(path)
+
+    def test_push_parser(self):
+        with open(self.path, 'rb') as f:
+            xml = f.read()
+        parser = drill.DrillParser(xpath='catalog/book')
+        books = []
+        for i in range(0, len(xml), 100):
+            parser.feed(xml[i:i + 100])
+            books.extend(parser.pop_elements())
+        self.assertEqual([b['id'] for b in books], ['book1', 'book2'])
+        self.assertEqual(parser.pop_elements(), [])
+        root = parser.close()
+        self.assertEqual(root.tagname, 'catalog')
+        # Without an xpath, every element is completed, and the whole document is available from close.
+        found = []
+        parser = drill.DrillParser(callback=lambda e: found.append(e.tagname))
+        parser.feed(xml)
+        self.assertEqual(parser.close().xml(), self.catalog.xml())
+        # Elements are completed children first, ending with the root.
+        self.assertEqual(sorted(found), sorted([e.tagname for e in self.catalog.iter()] + ['catalog']))
+        self.assertEqual(found[-1], 'catalog')
+        self.assertEqual(parser.pop_elements(), [])
+
+    @unittest.skipUnless(drill.PY3, 'asyncio requires Python 3')
+    def test_async_iterparse(self):
+        import asyncio
+        with open(self.path, 'rb') as f:
+            xml = f.read()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            parser = drill.AsyncIterParser(xpath='catalog/book/title')
+            # Feed the document in small chunks from the event loop, as a stream would.
+            for i in range(0, len(xml), 50):
+                loop.call_soon(parser.feed, xml[i:i + 50])
+            loop.call_soon(parser.close)
+            titles = []
+            while True:
+                try:
+                    titles.append(unicode(loop.run_until_complete(parser.__anext__())))
+                except StopAsyncIteration:
+                    break
+            self.assertEqual(titles, ['Test Book', u('Él Libro')])
+            # Parse errors are raised by feed, and passed on to the consumer.
+            parser = drill.AsyncIterParser()
+            waiting = parser.__anext__()
+            self.assertRaises(drill.expat.ExpatError, parser.feed, b'<a></b>')
+            self.assertRaises(drill.expat.ExpatError, loop.run_until_complete, waiting)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_stats(self):
+        with open(self.path, 'rb') as f:
+            xml = f.read()
+        stats = drill.ParseStats()
+        doc = drill.parse(self.path, stats=stats)
+        count = len(list(doc.iter())) + 1
+        self.assertEqual(stats.bytes_fed, len(xml))
+        self.assertEqual((stats.elements, stats.elements_created, stats.elements_skipped), (count, count, 0))
+        self.assertGreater(stats.cdata_fragments, 0)
+        self.assertEqual(drill.parse(xml, stats=drill.ParseStats()).xml(), doc.xml())
+        # Elements outside the xpath are skipped, and the queue never holds more than max_pending elements (when slices
+        # are small enough to hold one element).
+        stats = drill.ParseStats()
+        elem_iter = drill.iterparse(io.BytesIO(xml), xpath='catalog/book/title', max_pending=1, chunk_size=64, stats=stats)
+        titles = list(elem_iter)
+        self.assertEqual(len(titles), 2)
+        self.assertEqual(stats.bytes_fed, len(xml))
+        self.assertEqual(stats.elements, count)
+        self.assertEqual(stats.elements_created + stats.elements_skipped, count)
+        # The root, both books, and their titles.
+        self.assertEqual(stats.elements_created, 5)
+        self.assertEqual(stats.queue_high_water, 1)
+        stats = drill.ParseStats()
+        parser = drill.DrillParser(xpath='catalog/*', stats=stats)
+        parser.feed(xml)
+        self.assertEqual(stats.queue_high_water, 3)
+        self.assertEqual(stats.as_dict()['bytes_fed'], len(xml))
+        # Query stats count every node checked against a step, and every predicate evaluated.
+        query = doc.find('book[@id="book2"]/title', stats=True)
+        self.assertEqual(len(list(query)), 1)
+        # Three children of the root, two of which are books, then the four children of the matching book.
+        self.assertEqual((query.stats.nodes_visited, query.stats.predicates_evaluated), (7, 2))
+        self.assertIsNone(doc.find('//title').stats)
+        doc.build_index().build()
+        query = doc.find('//title', stats=True)
+        self.assertEqual(len(list(query)), 4)
+        self.assertEqual((query.stats.nodes_visited, query.stats.index_searches), (0, 1))
+
+    def test_snapshot(self):
+        fd, path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(fd)
+        try:
+            self.catalog.save_snapshot(path)
+            doc = drill.load_snapshot(path)
+            self.assertIsInstance(doc, drill.XmlElement)
+            self.assertEqual(doc.xml(), self.catalog.xml())
+            self.assertEqual(doc[1].author.data, u('Rodriguez, José'))
+            self.assertEqual(doc[1].index, 1)
+            self.assertIsNone(doc.index)
+            doc.append('new')
+            compact = drill.load_snapshot(path, compact=True)
+            self.assertIsInstance(compact, drill.CompactElement)
+            self.assertEqual(compact.xml(), self.catalog.xml())
+            self.assertEqual([e['id'] for e in compact.find('book')], ['book1', 'book2'])
+            # Compact documents (including snapshots) can be saved again, as can subtrees.
+            compact.save_snapshot(path)
+            self.assertEqual(drill.load_snapshot(path).xml(), self.catalog.xml())
+            self.catalog.magazine.save_snapshot(path)
+            self.assertEqual(drill.load_snapshot(path, element_class=CustomElement).xml(), self.catalog.magazine.xml())
+            with open(path, 'wb') as f:
+                f.write(b'<catalog/>')
+            self.assertRaises(ValueError, drill.load_snapshot, path)
+        finally:
+            os.remove(path)
+
+    @unittest.skipUnless(drill.PY3, 'uses unittest.mock')
+    def test_snapshot_truncated(self):
+        from unittest import mock
+        fd, path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(fd)
+        try:
+            # Truncated snapshots raise ValueError, and aren't left mapped.
+            self.catalog.save_snapshot(path)
+            with open(path, 'rb') as f:
+                snapshot = f.read()
+            maps = []
+            original_map_file = drill.map_file
+
+            def map_file(f):
+                maps.append(original_map_file(f))
+                return maps[-1]
+            with mock.patch('drill.map_file', map_file):
+                for size in (0, 4, 12, 40, len(snapshot) - 1):
+                    with open(path, 'wb') as f:
+                        f.write(snapshot[:size])
+                    self.assertRaises(ValueError, drill.load_snapshot, path)
+            self.assertTrue(all(m.closed for m in maps if isinstance(m, mmap.mmap)))
+        finally:
+            os.remove(path)
+
+    def test_parse_cache(self):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.close(fd)
+        with open(self.path, 'rb') as src, open(path, 'wb') as dst:
+            dst.write(src.read())
+        try:
+            cache = drill.ParseCache()
+            doc = cache.parse(path)
+            self.assertIs(cache.parse(path), doc)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            # Changing the file invalidates the cached document.
+            with open(path, 'wb') as f:
+                f.write(b'<catalog><book id="new"/></catalog>')
+            st = os.stat(path)
+            os.utime(path, (st.st_atime, st.st_mtime + 10))
+            self.assertEqual(cache.parse(path).book['id'], 'new')
+            self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 2, 1))
+            # Copies are equal, but independent.
+            cache = drill.ParseCache(copy=True, handler_class=CustomHandler)
+            first, second = cache.parse(path), cache.parse(path)
+            self.assertIsNot(first, second)
+            self.assertIsInstance(second, CustomElement)
+            self.assertEqual(first.xml(), second.xml())
+            # Entries are evicted by count and by size.
+            cache = drill.ParseCache(max_entries=1)
+            cache.parse(path)
+            cache.parse(self.path)
+            self.assertEqual(list(cache.entries), [self.path])
+            cache = drill.ParseCache(max_size=os.path.getsize(path))
+            cache.parse(path)
+            cache.parse(self.path)
+            self.assertEqual(list(cache.entries), [path])
+        finally:
+            os.remove(path)
+
+    @unittest.skipUnless(drill.PY3, 'uses http.server')
+    def test_parse_cache_url(self):
+        import http.server
+        import threading
+        with open(self.path, 'rb') as f:
+            xml = f.read()
+        requests = []
+
+        class Handler (http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.headers.get('If-None-Match'))
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', str(len(xml)))
+                self.end_headers()
+                self.wfile.write(xml)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/catalog.xml' % server.server_address[1]
+            cache = drill.ParseCache()
+            doc = cache.parse(url)
+            self.assertEqual(doc.xml(), self.catalog.xml())
+            self.assertIs(cache.parse(url), doc)
+            self.assertEqual(requests, [None, '"v1"'])
+            self.assertEqual(cache.size, len(xml))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @unittest.skipUnless(drill.PY3, 'uses http.server')
+    def test_http_pool(self):
+        import gzip
+        import http.server
+        import threading
+        with open(self.path, 'rb') as f:
+            xml = f.read()
+        connections = []
+        encodings = []
+
+        class Handler (http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                http.server.BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                if self.path == '/old':
+                    self.send_response(301)
+                    self.send_header('Location', '/catalog.xml')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if self.path == '/missing.xml':
+                    self.send_error(404)
+                    return
+                encodings.append(self.headers.get('Accept-Encoding'))
+                if self.path == '/big.xml':
+                    # 200 copies of the catalog (without its XML declaration) in one document.
+                    body = gzip.compress(b'<big>' + xml.split(b'?>', 2)[2] * 200 + b'</big>')
+                else:
+                    body = gzip.compress(xml)
+                self.send_response(200)
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            base = 'http://127.0.0.1:%d' % server.server_address[1]
+            self.assertEqual(drill.parse(base + '/catalog.xml').xml(), self.catalog.xml())
+            self.assertEqual(drill.parse(base + '/old').xml(), self.catalog.xml())
+            titles = [unicode(e) for e in drill.iterparse(base + '/catalog.xml', xpath='catalog/book/title')]
+            self.assertEqual(titles, ['Test Book', u('Él Libro')])
+            # The compressed body is decompressed in pieces as it's read.
+            with drill.http_pool.open(base + '/big.xml') as f:
+                pieces = iter(lambda: f.read(1000), b'')
+                self.assertTrue(all(len(p) <= 1000 for p in pieces))
+            self.assertEqual(len(list(drill.iterparse(base + '/big.xml', xpath='big/catalog/book'))), 400)
+            # Every request went over a single keep-alive connection, and asked for gzip.
+            self.assertEqual(len(connections), 1)
+            self.assertEqual(set(encodings), set(['gzip']))
+            self.assertRaises(drill.url_lib.HTTPError, drill.parse, base + '/missing.xml')
+        finally:
+            drill.http_pool.clear()
+            server.shutdown()
+            server.server_close()
+
+    def test_pickle_copy(self):
+        import copy
+        import pickle
+        doc = drill.parse(b'<r><a/><b y="2"/><c/></r>')
+        for copied in (pickle.loads(pickle.dumps(doc, 2)), pickle.loads(pickle.dumps(doc, -1)), copy.deepcopy(doc)):
+            self.assertEqual(copied.xml(), doc.xml())
+            # Elements without attributes still have independent attribute dicts once they are modified.
+            self.assertIs(copied[0]._attrs, drill._EMPTY_ATTRS)
+            copied[0].attrs['x'] = '1'
+            self.assertEqual((copied.attrs, copied[1].attrs, copied[2].attrs), ({}, {'y': '2'}, {}))
+        self.assertEqual(doc[0].attrs, {})
+        self.assertRaises(TypeError, drill._EMPTY_ATTRS.update, {'x': '1'})
+
+    @unittest.skipUnless(drill.PY3, 'uses http.server')
+    def test_http_proxy(self):
+        import http.server
+        import threading
+        from unittest import mock
+        with open(self.path, 'rb') as f:
+            xml = f.read()
+        paths = []
+
+        class Handler (http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                paths.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(xml)))
+                self.end_headers()
+                self.wfile.write(xml)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        address = 'http://127.0.0.1:%d' % server.server_address[1]
+        try:
+            # Proxied URLs are requested from the proxy, with the full URL as the path.
+            with mock.patch.dict(os.environ, {'http_proxy': address, 'no_proxy': ''}):
+                self.assertEqual(drill.parse('http://drill.invalid/catalog.xml').xml(), self.catalog.xml())
+                self.assertEqual(paths, ['http://drill.invalid/catalog.xml'])
+            # Hosts in no_proxy are connected to directly.
+            with mock.patch.dict(os.environ, {'http_proxy': 'http://127.0.0.1:9', 'no_proxy': '127.0.0.1'}):
+                self.assertEqual(drill.parse(address + '/catalog.xml').xml(), self.catalog.xml())
+                self.assertEqual(paths[-1], '/catalog.xml')
+        finally:
+            drill.http_pool.clear()
+            server.shutdown()
+            server.server_close()
+
     def test_parse(self):
         # Parse out the drive on Windows, they don't play nice with file:// URLs.
         drive, path = os.path.splitdrive(self.path)
@@ -110,6 +672,94 @@ class DrillTests (unittest.TestCase):
         e = drill.XmlElement('tag', attrs={'foo\x02': 'ba&r\x05'}, data='tes\x01\x03t<ing')
         self.assertEqual(e.xml(pretty=False).decode('utf-8'), '<tag foo="ba&amp;r">test&lt;ing</tag>')
 
+    def test_writer_buffering(self):
+        s = drill.bytes_io()
+        writer = drill.XmlWriter(s, pretty=False, buffer_size=1024)
+        writer.start('root', {'a': 'x"y'})
+        writer.simple_tag('child', data='one & two')
+        # Nothing is written until the buffer fills up, the outermost element is closed, or the writer is flushed.
+        self.assertEqual(s.getvalue(), b'')
+        writer.flush()
+        self.assertEqual(s.getvalue(), b'<root a=\'x"y\'><child>one &amp; two</child>')
+        writer.end('root')
+        self.assertEqual(s.getvalue(), b'<root a=\'x"y\'><child>one &amp; two</child></root>')
+        # Small buffers are written through as they fill up.
+        s = drill.bytes_io()
+        writer = drill.XmlWriter(s, pretty=False, buffer_size=4)
+        writer.start('root', {})
+        self.assertEqual(s.getvalue(), b'<root>')
+        # Replacements longer than one character still work.
+        e = drill.XmlElement('tag', attrs={'a': 'abc'}, data='abc')
+        self.assertEqual(e.xml(pretty=False, replacements={'bc': 'BC'}), b'<tag a="aBC">aBC</tag>')
+
+    def test_write_deep(self):
+        root = drill.XmlElement('root')
+        e = root
+        for i in range(5000):
+            e = e.append('level', data=str(i))
+        # Serializing should not be limited by the recursion limit.
+        xml = root.xml(pretty=False)
+        self.assertTrue(xml.startswith(b'<root><level>0<level>1<level>2'))
+        self.assertTrue(xml.endswith(b'</level></level></root>'))
+        self.assertEqual(xml.count(b'</level>'), 5000)
+        # Pretty printing nested elements.
+        doc = drill.parse('<a><b x="1"><c/></b><d>three</d></a>')
+        self.assertEqual(doc.xml(), b'<a>\n    <b x="1">\n        <c></c>\n    </b>\n    <d>three</d>\n</a>\n')
+
+    def test_streaming_writer(self):
+        s = drill.bytes_io()
+        with drill.XmlWriter(s, buffer_size=16) as w:
+            with w.element('catalog', {'name': 'sample'}):
+                with w.element('book', {'id': 'book1'}):
+                    w.simple_tag('author', data='Watson, Dan')
+                    with w.element('title', {'language': 'en'}, data='Test Book'):
+                        pass
+                with w.element('magazine', data='Some data'):
+                    w.simple_tag('price', {'marked': '0'}, data='USD5.99')
+                    # Existing trees can be spliced in.
+                    w.serialize(self.catalog.magazine.book)
+                with w.element('empty'):
+                    pass
+        expected = drill.XmlElement('catalog', {'name': 'sample'})
+        book = expected.append('book', {'id': 'book1'})
+        book.append('author', data='Watson, Dan')
+        book.append('title', {'language': 'en'}, data='Test Book')
+        magazine = expected.append('magazine', data='Some data')
+        magazine.append('price', {'marked': '0'}, data='USD5.99')
+        nested = magazine.append('book')
+        nested.append('title', data='Nonsense')
+        nested.append('isbn', data='0-000-00000-0')
+        expected.append('empty')
+        self.assertEqual(s.getvalue(), expected.xml())
+        # Re-emit filtered iterparse output as a stream.
+        s = drill.bytes_io()
+        with drill.XmlWriter(s, pretty=False) as w:
+            w.declaration()
+            with w.element('titles'):
+                for e in drill.iterparse(open(self.path, 'rb'), xpath='catalog/*/title', release=True):
+                    w.serialize(e)
+        self.assertTrue(s.getvalue().startswith(b'<?xml version="1.0" encoding="utf-8"?>\n<titles><title'))
+        self.assertEqual(drill.parse(s.getvalue()).xml(pretty=False), u(
+            '<titles><title language="en">Test Book</title><title language="es">Él Libro</title>'
+            '<title language="en">Test Magazine</title></titles>').encode('utf-8'))
+        # An exception inside an element unwinds the writer, and the unfinished element isn't written.
+        s = drill.bytes_io()
+        w = drill.XmlWriter(s, pretty=False)
+        with w.element('done'):
+            pass
+        try:
+            with w:
+                with w.element('a'):
+                    with w.element('b'):
+                        raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual((w.level, w._open), (0, []))
+        self.assertEqual(s.getvalue(), b'<done></done>')
+        with w.element('c'):
+            w.simple_tag('d')
+        self.assertEqual(s.getvalue(), b'<done></done><c><d></d></c>')
+
     def test_build(self):
         e = drill.XmlElement('root', data='some data')
         s = e.append('second', data='two')
@@ -138,6 +788,50 @@ class DrillTests (unittest.TestCase):
         self.assertEqual(e.tagname, 'catalog')
         self.assertEqual(len(e), 0)
 
+    def test_iterparse_max_pending(self):
+        xml = b'<root>' + b''.join(b'<record id="%d"/>' % i for i in range(5000)) + b'</root>'
+        elem_iter = drill.iterparse(drill.bytes_io(xml), xpath='root/record', max_pending=10)
+        ids = []
+        for e in elem_iter:
+            # Feeding pauses once max_pending elements are waiting (give or take one slice worth of elements).
+            self.assertTrue(len(elem_iter.elements) < 10 + elem_iter.FEED_SLICE_SIZE // 10)
+            ids.append(int(e['id']))
+        self.assertEqual(ids, list(range(5000)))
+        # Exhausted iterators should stay exhausted.
+        self.assertRaises(StopIteration, next, elem_iter)
+
+    def test_iterparse_release(self):
+        xml = b'<root><group>' + b''.join(b'<record id="%d"><x/></record><skip/>' % i for i in range(1000)) + b'</group></root>'
+        parents = set()
+        records = []
+        elem_iter = drill.iterparse(drill.bytes_io(xml), xpath='root/group/record', release=True, chunk_size=256)
+        for e in elem_iter:
+            # Consumed elements are trimmed between chunks, and the remaining siblings are renumbered.
+            self.assertLess(len(e.parent), 50)
+            self.assertIs(e.parent[e.index], e)
+            prev, nxt = e.prev(), e.next()
+            if prev is not None:
+                self.assertEqual(int(prev['id']), int(e['id']) - 1)
+                self.assertIs(prev.next(), e)
+            if nxt is not None:
+                self.assertEqual(int(nxt['id']), int(e['id']) + 1)
+                self.assertIs(nxt.prev(), e)
+            self.assertEqual(len(e), 1)
+            parents.add(e.parent)
+            records.append(e)
+        self.assertEqual([int(e['id']) for e in records], list(range(1000)))
+        self.assertTrue(all(e.parent is None for e in records))
+        self.assertEqual(len(parents), 1)
+        self.assertEqual(len(parents.pop()), 0)
+        # Without an xpath, every open element is still to be yielded, so nothing could be released.
+        self.assertRaises(ValueError, drill.iterparse, drill.bytes_io(b'<r/>'), release=True)
+        # Nested matches keep their children until the outer match is released.
+        xml = b'<r><item id="1"><item id="2"/></item><item id="3"/></r>'
+        yielded = []
+        for e in drill.iterparse(drill.bytes_io(xml), xpath='//item', release=True):
+            yielded.append((e['id'], len(e)))
+        self.assertEqual(yielded, [('2', 0), ('1', 1), ('3', 0)])
+
     def test_custom_handler_class(self):
         doc = drill.parse(self.path, handler_class=CustomHandler)
         self.assertEqual(doc[0].__class__, CustomElement)
@@ -156,6 +850,52 @@ class DrillTests (unittest.TestCase):
             self.assertEqual(len(elements), 3)
             self.assertEqual([e.data for e in elements], ['Test Book', u('Él Libro'), 'Test Magazine'])
 
+    def test_iterparse_xpath_descendants(self):
+        with open(self.path, 'rb') as f:
+            elements = list(drill.iterparse(f, xpath='//title'))
+            self.assertEqual([e.data for e in elements], ['Test Book', u('Él Libro'), 'Test Magazine', 'Nonsense'])
+            # Elements only passed over by the // are never built, so matches hang off the nearest built ancestor.
+            self.assertEqual(set(e.parent.tagname for e in elements), set(['catalog']))
+        with open(self.path, 'rb') as f:
+            elements = list(drill.iterparse(f, xpath='catalog//book/isbn'))
+            self.assertEqual([e.data for e in elements], ['0-684-84328-5', '0-684-84328-6', '0-000-00000-0'])
+        # Attribute predicates are evaluated at start-tag time.
+        with open(self.path, 'rb') as f:
+            elements = list(drill.iterparse(f, xpath='//*[@marked]'))
+            self.assertEqual([e.tagname for e in elements], ['isbn', 'price'])
+        with open(self.path, 'rb') as f:
+            elements = list(drill.iterparse(f, xpath='//*[@author="watsond"]/title'))
+            self.assertEqual([e.data for e in elements], ['Test Book', 'Test Magazine'])
+        # Child predicates on the last step are checked once the element is complete.
+        with open(self.path, 'rb') as f:
+            elements = list(drill.iterparse(f, xpath='//book[isbn="0-000-00000-0"]'))
+            self.assertEqual([e.title.data for e in elements], ['Nonsense'])
+        self.assertRaises(ValueError, drill.iterparse, drill.bytes_io(b'<a/>'), xpath='a[0]/b')
+        self.assertRaises(ValueError, drill.iterparse, drill.bytes_io(b'<a/>'), xpath='a[b]/b')
+
+    def test_iterparse_multiple_xpaths(self):
+        xpaths = {
+            'books': 'catalog/book',
+            'titles': 'catalog/*/title',
+            'english': 'catalog/*/title[@language="en"]',
+            'nested': '//magazine//isbn',
+        }
+        with open(self.path, 'rb') as f:
+            pairs = [(name, e.path()) for name, e in drill.iterparse(f, xpath=xpaths)]
+        self.assertEqual(sorted(pairs), sorted([
+            ('titles', 'book[0]/title[2]'), ('english', 'book[0]/title[2]'), ('books', 'book[0]'),
+            ('titles', 'book[1]/title[2]'), ('books', 'book[1]'),
+            # Only elements on a matching path are built, so the magazine has no author, and the book inside it (which is
+            # only passed over by the //) isn't built.
+            ('titles', 'magazine[2]/title[0]'), ('english', 'magazine[2]/title[0]'),
+            ('nested', 'magazine[2]/isbn[1]'),
+        ]))
+        # Pairs come out in document (completion) order.
+        self.assertEqual([p[1] for p in pairs][:3], ['book[0]/title[2]', 'book[0]/title[2]', 'book[0]'])
+        # The shared catalog/* prefix is only one step in the filter.
+        xfilter = drill.XPathFilter(xpaths)
+        self.assertEqual(len(xfilter.edges[0]), 2)
+
     def test_json(self):
         doc = drill.parse("""
             <root>
@@ -170,6 +910,20 @@ class DrillTests (unittest.TestCase):
             </root>
         """)
         self.assertEqual(doc.json(), {'e1': 'hello', 'e2': ['world', 'this'], 'e3': {'e4': {'e5': 'is a test'}}})
+        self.assertEqual(doc.json(attributes=True, force_list=['e1']), {
+            'e1': ['hello'], 'e2': ['world', {'@attr': 'ignore', '#text': 'this'}], 'e3': {'e4': {'e5': 'is a test'}}})
+        # Streaming output matches json.dumps of the converted value.
+        for kwargs in ({}, {'attributes': True}, {'force_list': ['e5', 'title']}):
+            for e in (doc, self.catalog, self.catalog.book.title):
+                s = io.StringIO()
+                e.write_json(s, chunk_size=8, **kwargs)
+                self.assertEqual(s.getvalue(), u(json.dumps(e.json(**kwargs))))
+        # Elements from iterparse can be written as JSON lines.
+        s = io.StringIO()
+        for e in drill.iterparse(open(self.path, 'rb'), xpath='catalog/book', release=True):
+            e.write_json(s, attributes=True)
+            s.write(u('\n'))
+        self.assertEqual([json.loads(line)['@id'] for line in s.getvalue().splitlines()], ['book1', 'book2'])
 
 
 if __name__ == '__main__':